@@ -0,0 +1,101 @@
+# Small in-process caches.
+
+import threading, time
+
+__all__ = ['LRUCache']
+
+class LRUCache:
+    """
+    Dictionary-like cache holding at most 'size' entries.  When full,
+    the least recently used entry is dropped.  If ttl is set, entries
+    also expire that many seconds after being put.
+    """
+
+    def __init__(self, size = 1000, ttl = None):
+        self.size = size
+        self.ttl = ttl
+        self.clock = time.time
+        self.hits = 0
+        self.misses = 0
+
+        # key -> [prev, next, key, value, expiry] links of a circular
+        # list whose head is the most recently used entry.
+        self.__map = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None, None]
+        self.__lock = threading.Lock()
+
+    def __unlink(self, link):
+        (prev, next) = (link[0], link[1])
+        prev[1] = next
+        next[0] = prev
+
+    def __push(self, link):
+        root = self.__root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def get(self, key, default = None):
+        self.__lock.acquire()
+        try:
+            link = self.__map.get(key)
+            if link != None and link[4] != None and link[4] <= self.clock():
+                self.__unlink(link)
+                del self.__map[key]
+                link = None
+            if link == None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.__unlink(link)
+            self.__push(link)
+            return link[3]
+        finally:
+            self.__lock.release()
+
+    def put(self, key, value):
+        expiry = None
+        if self.ttl != None: expiry = self.clock() + self.ttl
+
+        self.__lock.acquire()
+        try:
+            link = self.__map.get(key)
+            if link != None:
+                link[3] = value
+                link[4] = expiry
+                self.__unlink(link)
+            else:
+                if len(self.__map) >= self.size:
+                    last = self.__root[0]
+                    self.__unlink(last)
+                    del self.__map[last[2]]
+                link = [None, None, key, value, expiry]
+                self.__map[key] = link
+            self.__push(link)
+        finally:
+            self.__lock.release()
+
+    def remove(self, key):
+        self.__lock.acquire()
+        try:
+            link = self.__map.pop(key, None)
+            if link != None: self.__unlink(link)
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__map.clear()
+            self.__root[:] = [self.__root, self.__root, None, None, None]
+        finally:
+            self.__lock.release()
+
+    def __contains__(self, key):
+        return key in self.__map
+
+    def __len__(self):
+        return len(self.__map)
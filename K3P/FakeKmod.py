@@ -0,0 +1,223 @@
+# Fake KMOD.
+#
+# This speaks just enough K3P to let a Plugin run end to end without
+# KMOD and its KPS backend.  Every request succeeds and the replies
+# are filled with meaningless data of configurable sizes.  It is meant
+# to benchmark the Python K3P stack and catch regressions in it.
+#
+# It is started exactly like KMOD, see the 'fakekmod' script.  The
+# sizes are read from the [fakekmod] section of 'fakekmod.ini' in the
+# KMOD directory or, if there is none, from the file named like the
+# executable with '.ini' appended:
+#
+# [fakekmod]
+# body_size = 4096    ; Size of the bodies returned.
+# latency = 0         ; Milliseconds to wait before each reply.
+
+import os, sys, socket, getopt, time
+from ConfigParser import ConfigParser
+from Protocol import *
+from Constants import *
+
+__all__ = ['FakeKmod']
+
+class FakeKmod:
+    def __init__(self, kmod_dir):
+        self.kmod_dir = kmod_dir
+        self.body_size = 4096
+        self.latency = 0.0
+        self.conn = K3PConnection()
+        self.log = None
+
+        logs_dir = os.path.join(kmod_dir, "kmod_logs")
+        if not os.path.exists(logs_dir):
+            os.mkdir(logs_dir)
+        self.log = open(os.path.join(logs_dir, "fakekmod.log"), "a")
+
+    def load_config(self, paths):
+        """
+        Read the configuration from the first file of 'paths' that
+        exists.
+        """
+        for path in paths:
+            if os.path.exists(path):
+                cfg = ConfigParser()
+                cfg.read(path)
+                if cfg.has_option("fakekmod", "body_size"):
+                    self.body_size = cfg.getint("fakekmod", "body_size")
+                if cfg.has_option("fakekmod", "latency"):
+                    self.latency = cfg.getfloat("fakekmod", "latency") / 1000
+                return
+
+    def payload(self, seed = "K"):
+        return (seed * self.body_size)[:self.body_size]
+
+    def connect_kmod(self, host, port, path = None):
+        """
+        Connect to the plugin and complete the secret handshake, like
+        KMOD does in kmod_connect mode.  If path is set, connect to
+        that Unix domain socket instead of host:port.
+        """
+        secret = os.urandom(16).encode("hex")
+        secret_file = open(os.path.join(self.kmod_dir, "connect_secret"), "w")
+        secret_file.write(secret)
+        secret_file.close()
+
+        if path:
+            transport = UnixTransport(path)
+        else:
+            transport = TCPTransport(host, port)
+        transport.connect()
+        transport.sendall(secret)
+        self.conn.attach(transport)
+
+    def listen_kpp(self, host, port, path = None):
+        """
+        Wait for the plugin to connect, like KMOD does in kpp_connect
+        mode.  If path is set, listen on that Unix domain socket
+        instead of host:port.
+        """
+        if path:
+            srv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            srv_sock.bind(path)
+        else:
+            srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            srv_sock.bind((host, port))
+        srv_sock.listen(1)
+        (sock, _) = srv_sock.accept()
+        srv_sock.close()
+        if path:
+            os.unlink(path)
+            self.conn.attach(UnixTransport(sock = sock))
+        else:
+            self.conn.attach(TCPTransport(sock = sock))
+
+    def reply(self, inst, *structs):
+        """
+        Write an instruction followed by the given structures.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.conn.write_instruction(inst)
+        for s in structs:
+            self.conn.write(s)
+
+    def package(self, inst):
+        mail = self.conn.read_structure(K3pMail)
+        mb = K3pMailBody()
+        mb.type = mail.body.type
+        if mail.body.text: mb.text = self.payload("T")
+        if mail.body.html: mb.html = self.payload("H")
+        self.reply(KMO_PACK_ACK, mb)
+
+    def evaluate(self):
+        mail = self.conn.read_structure(K3pMail)
+        res = KmoEvalRes()
+        res.sig_valid = 1
+        res.sig_msg = ""
+        res.subscriber_name = mail.from_name
+        for f in ['from_name_status', 'from_addr_status', 'to_status', 'cc_status',
+                  'subject_status', 'body_text_status', 'body_html_status']:
+            setattr(res, f, KMO_FIELD_STATUS_INTACT)
+        res.attachment_nbr = mail.attachment_nbr
+        for a in mail.attachments:
+            ra = KmoEvalResAttachment()
+            ra.name = a.name
+            ra.status = KMO_EVAL_ATTACHMENT_INTACT
+            res.attachments.append(ra)
+        res.encryption_status = KMO_DECRYPTION_STATUS_NONE
+        res.pod_status = KMO_POD_STATUS_NONE
+        res.otut.status = KMO_OTUT_STATUS_NONE
+        self.reply(KMO_EVAL_STATUS, K3PInteger(1), res)
+
+    def process(self):
+        req = self.conn.read_structure(KppMailProcessReq)
+        mail = req.mail
+        if mail.body.text: mail.body.text = self.payload("T")
+        if mail.body.html: mail.body.html = self.payload("H")
+        mail.otut.status = KMO_OTUT_STATUS_NONE
+        self.reply(KMO_PROCESS_ACK, mail)
+
+    def session(self):
+        """
+        Handle the command of a KPP_BEG_SESSION.
+        """
+        inst = self.conn.read_instruction().inst
+        self.log.write("command %08x\n" % inst)
+
+        if inst == KPP_IS_KSERVER_INFO_VALID:
+            self.conn.read_structure(KppServerInfo)
+            self.reply(KMO_SERVER_INFO_ACK, K3PString(self.payload("S")[:32]))
+        elif inst == KPP_SET_KSERVER_INFO:
+            self.conn.read_structure(KppServerInfo)
+        elif inst in [KPP_SIGN_MAIL, KPP_SIGN_N_POD_MAIL,
+                      KPP_SIGN_N_ENCRYPT_MAIL, KPP_SIGN_N_ENCRYPT_N_POD_MAIL]:
+            self.package(inst)
+        elif inst == KPP_EVAL_INCOMING:
+            self.evaluate()
+        elif inst == KPP_PROCESS_INCOMING:
+            self.process()
+        else:
+            self.reply(KMO_INVALID_REQ)
+
+    def serve(self):
+        """
+        Handle instructions until the plugin disconnects.
+        """
+        while True:
+            inst = self.conn.read_instruction().inst
+
+            if inst == KPP_CONNECT_KMO:
+                self.conn.read_structure(KppMua)
+                ti = KmoToolInfo()
+                ti.sig_marker = "Fake KMOD signature"
+                ti.kmo_version = "fakekmod"
+                ti.k3p_version = "%d.%d" % (K3P_VER_MAJOR, K3P_VER_MINOR)
+                self.reply(KMO_COGITO_ERGO_SUM, ti)
+            elif inst == KPP_BEG_SESSION:
+                self.session()
+            elif inst == KPP_END_SESSION:
+                pass
+            elif inst == KPP_DISCONNECT_KMO:
+                break
+            else:
+                raise K3PFatalError("Unexpected instruction %08x" % inst)
+        self.conn.close()
+
+def main(args, prog = "fakekmod"):
+    """
+    Run a fake KMOD with KMOD's command line arguments.
+    """
+    opts, _ = getopt.getopt(args, "C:l:p:u:k:")
+    mode = "kmod_connect"
+    port = 29999
+    path = None
+    kmod_dir = None
+    for o, a in opts:
+        if o == "-C":
+            mode = a
+        elif o == "-p":
+            port = int(a)
+        elif o == "-u":
+            path = a
+        elif o == "-k":
+            kmod_dir = a
+
+    if not kmod_dir:
+        sys.stderr.write("KMOD directory (-k) is mandatory.\n")
+        return 1
+
+    kmod = FakeKmod(kmod_dir)
+    kmod.load_config([os.path.join(kmod_dir, "fakekmod.ini"), prog + ".ini"])
+
+    try:
+        if mode == "kmod_connect":
+            kmod.connect_kmod("localhost", port, path)
+        else:
+            kmod.listen_kpp("localhost", port, path)
+        kmod.serve()
+    except (K3PException, K3PFatalError, socket.error), ex:
+        kmod.log.write("exiting: %s\n" % ex)
+        return 1
+    return 0
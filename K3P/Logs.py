@@ -0,0 +1,164 @@
+# Background archiving of KMOD logs.
+#
+# Saving the logs of a failed test used to copy them file by file
+# before the test could go on.  Now the log directory is only moved
+# aside, which is a rename, and worker threads write it to a single
+# compressed archive in the destination directory.  The total size of
+# the archives in that directory can be capped, in which case the
+# least recently used ones are removed first.
+#
+# Archives still pending are completed before the process exits.
+
+import sys, os, errno, time, shutil, tarfile, tempfile, threading, atexit
+from Queue import Queue
+
+__all__ = ['LogArchiver', 'log_archiver', 'wait_log_archivers']
+
+class LogArchiver:
+    """
+    Archive log directories into destdir from worker threads.
+
+    max_bytes, if not None, is the number of bytes of archives kept in
+    destdir.
+    """
+
+    def __init__(self, destdir, max_bytes = None, workers = 2):
+        self.destdir = destdir
+        self.max_bytes = max_bytes
+        self.errors = []
+        self.__queue = Queue()
+        self.__lock = threading.Lock()
+        self.__serial = 0
+
+        if not os.path.exists(destdir):
+            os.makedirs(destdir)
+
+        for i in range(0, workers):
+            t = threading.Thread(target = self.__work)
+            t.setDaemon(True)
+            t.start()
+
+    def __work(self):
+        while True:
+            (staging, name) = self.__queue.get()
+            try:
+                try:
+                    path = self.archive(staging, name)
+                    self.evict(path)
+                except Exception, ex:
+                    self.errors.append((name, ex))
+            finally:
+                shutil.rmtree(staging, True)
+                self.__queue.task_done()
+
+    def submit(self, logs_path, prefix = None, staging_dir = None):
+        """
+        Move the directory logs_path aside and queue it for archiving.
+        logs_path no longer exists when this returns.  Return the path
+        the archive will have.  Its name starts with prefix and is
+        made unique by the time, the process ID and a serial number,
+        so archives of earlier failures are never replaced.
+
+        The logs are moved to a new directory in staging_dir, the
+        system temporary directory by default.  This is a rename if
+        both are on the same file system and a copy otherwise.
+        """
+        self.__lock.acquire()
+        try:
+            self.__serial += 1
+            if not prefix: prefix = "kmod-logs"
+            name = "%s-%s-%d-%d" % (prefix, time.strftime("%Y%m%d%H%M%S"), os.getpid(), self.__serial)
+        finally:
+            self.__lock.release()
+
+        staging = tempfile.mkdtemp(prefix = "kmod_logs.", dir = staging_dir)
+        try:
+            os.rename(logs_path, os.path.join(staging, name))
+        except OSError, ex:
+            if ex.errno != errno.EXDEV:
+                shutil.rmtree(staging, True)
+                raise
+            shutil.copytree(logs_path, os.path.join(staging, name))
+            shutil.rmtree(logs_path)
+        self.__queue.put((staging, name))
+        return os.path.join(self.destdir, name + ".tar.gz")
+
+    def archive(self, staging, name):
+        """
+        Write the staged directory to destdir/name.tar.gz.
+        """
+        path = os.path.join(self.destdir, name + ".tar.gz")
+        tmp_path = path + ".part"
+        tar = tarfile.open(tmp_path, "w:gz")
+        try:
+            tar.add(os.path.join(staging, name), name)
+        finally:
+            tar.close()
+        os.rename(tmp_path, path)
+        return path
+
+    def evict(self, keep):
+        """
+        Remove the least recently used archives of destdir until they
+        fit in max_bytes.  keep is never removed.
+        """
+        if self.max_bytes == None: return
+
+        self.__lock.acquire()
+        try:
+            archives = []
+            total = 0
+            for n in os.listdir(self.destdir):
+                if not n.endswith(".tar.gz"): continue
+                p = os.path.join(self.destdir, n)
+                try:
+                    st = os.stat(p)
+                except OSError: continue
+                archives.append((max(st.st_atime, st.st_mtime), st.st_size, p))
+                total += st.st_size
+
+            archives.sort()
+            for (_, size, p) in archives:
+                if total <= self.max_bytes: break
+                if p == keep: continue
+                try:
+                    os.unlink(p)
+                    total -= size
+                except OSError: pass
+        finally:
+            self.__lock.release()
+
+    def wait(self):
+        """
+        Wait until all the submitted logs are archived.
+        """
+        self.__queue.join()
+
+# destdir -> LogArchiver
+_archivers = {}
+_archivers_lock = threading.Lock()
+
+def log_archiver(destdir):
+    """
+    Return the archiver shared by everything saving logs to destdir.
+    """
+    destdir = os.path.abspath(destdir)
+    _archivers_lock.acquire()
+    try:
+        if not destdir in _archivers:
+            _archivers[destdir] = LogArchiver(destdir)
+        return _archivers[destdir]
+    finally:
+        _archivers_lock.release()
+
+def wait_log_archivers():
+    """
+    Wait for all the pending archives, and report those that failed.
+    """
+    for a in _archivers.values():
+        a.wait()
+        for (name, ex) in a.errors:
+            sys.stderr.write("Failed to archive the logs %s: %s\n" % (name, ex))
+        a.errors = []
+
+atexit.register(wait_log_archivers)
@@ -0,0 +1,111 @@
+# Instrumentation of the K3P stack.
+#
+# A K3PMetrics object attached to a Plugin times the phases of every
+# plugin call and counts the bytes exchanged with KMOD.  The phases
+# are:
+#
+# - connect: starting KMOD and establishing the link with it.
+# - encode: serializing K3P elements and structures.
+# - write: writing to KMOD, flush included.
+# - wait: waiting for the first byte of KMOD's reply after a write.
+#   This is where the time KMOD spends processing, talking to the
+#   KPS included, goes.
+# - read: reading the rest of the reply.
+# - decode: turning K3P elements into structures.
+
+from collections import deque
+from ProfK.Clock import monotonic
+
+__all__ = ['K3PCallMetrics', 'K3PMetrics']
+
+class K3PCallMetrics:
+    """
+    Timings, in seconds, and byte counts of a call.  When used for
+    totals, 'count' is the number of calls added up.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 1
+        self.timers = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.elapsed = 0.0
+
+    def add_time(self, phase, secs):
+        self.timers[phase] = self.timers.get(phase, 0.0) + secs
+
+    def __str__(self):
+        t = " ".join(["%s=%.4f" % (p, self.timers[p]) for p in K3PMetrics.phases if p in self.timers])
+        return "%s: %.4fs [%s] out=%d in=%d" % (self.name, self.elapsed, t,
+                                              self.bytes_out, self.bytes_in)
+
+class K3PMetrics:
+    """
+    Collects K3PCallMetrics.
+
+    The last 'keep' calls are kept in 'calls'.  Totals per call name
+    are kept in 'totals'.  Each callback added by add_callback is
+    called with the K3PCallMetrics object of a call when the call is
+    done.
+
+    'clock' can be replaced by any function returning seconds.
+    """
+
+    phases = ["connect", "encode", "write", "wait", "read", "decode"]
+
+    def __init__(self, keep = 1000):
+        self.clock = monotonic
+        self.calls = deque([], keep)
+        self.totals = {}
+        self.callbacks = []
+        self.current = None
+        self.depth = 0
+        self.start = 0
+
+    def add_callback(self, cb):
+        self.callbacks.append(cb)
+
+    def begin(self, name):
+        """
+        Start measuring a call.  Nested calls are accounted to the
+        outermost one.
+        """
+        self.depth += 1
+        if self.depth == 1:
+            self.current = K3PCallMetrics(name)
+            self.start = self.clock()
+
+    def end(self):
+        """
+        Finish measuring the current call.
+        """
+        self.depth -= 1
+        if self.depth > 0: return
+
+        call = self.current
+        call.elapsed = self.clock() - self.start
+        self.current = None
+
+        self.calls.append(call)
+        if not call.name in self.totals:
+            self.totals[call.name] = K3PCallMetrics(call.name)
+            self.totals[call.name].count = 0
+        tot = self.totals[call.name]
+        tot.count += 1
+        tot.elapsed += call.elapsed
+        tot.bytes_out += call.bytes_out
+        tot.bytes_in += call.bytes_in
+        for (p, t) in call.timers.items():
+            tot.add_time(p, t)
+
+        for cb in self.callbacks:
+            cb(call)
+
+    def add_time(self, phase, secs):
+        if self.current: self.current.add_time(phase, secs)
+
+    def add_bytes(self, nout, nin):
+        if self.current:
+            self.current.bytes_out += nout
+            self.current.bytes_in += nin
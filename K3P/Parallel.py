@@ -0,0 +1,135 @@
+# Spread plugin calls over several KMOD instances.
+#
+# A KMOD handles one message at a time, so batch jobs are bound by
+# the speed of a single KMOD.  ParallelPlugin runs one Plugin, and
+# thus one KMOD, in each of a pool of worker processes and spreads the
+# messages over them.  Results come back in the order of the
+# messages.  A failure only concerns the message that caused it: its
+# result is a ParallelError instead of an exception interrupting the
+# batch.
+#
+# Messages and results go through pickle between the processes.
+
+import os, signal, multiprocessing
+from multiprocessing.util import Finalize
+from Plugin import *
+
+__all__ = ['ParallelPlugin', 'ParallelError']
+
+class ParallelError(Exception):
+    """
+    Failure of one message of a ParallelPlugin batch.  'kind' is the
+    name of the class of the exception raised in the worker.
+    """
+    def __init__(self, msg = None, kind = None):
+        Exception.__init__(self, msg, kind)
+        self.kind = kind
+
+    def __str__(self):
+        return "%s: %s" % (self.kind, self.args[0])
+
+# The plugin of the current worker process.
+_plugin = None
+_plugin_args = None
+
+def _start_plugin():
+    global _plugin
+    (kmod_path, kwargs, attrs) = _plugin_args
+    _plugin = Plugin(kmod_path, **kwargs)
+    for (k, v) in attrs.items():
+        setattr(_plugin, k, v)
+    _plugin.start()
+    if _plugin.kps_host:
+        _plugin.set_server_info()
+
+def _stop_plugin():
+    global _plugin
+    if _plugin:
+        try:
+            try:
+                _plugin.stop()
+            finally:
+                _plugin.conn.clean()
+        finally:
+            _plugin = None
+
+def _on_sigterm(signum, frame):
+    # Pool.terminate() kills the workers with SIGTERM, in which case
+    # the finalizer doesn't run.  Kill KMOD and remove its directory
+    # before exiting.
+    try:
+        if _plugin: _plugin.conn.clean()
+    finally:
+        os._exit(128 + signum)
+
+def _init_worker(kmod_path, kwargs, attrs):
+    global _plugin_args
+    _plugin_args = (kmod_path, kwargs, attrs)
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    _start_plugin()
+
+    # Stop KMOD when the worker exits.
+    Finalize(None, _stop_plugin, exitpriority = 10)
+
+def _call(job):
+    (method, args) = job
+    try:
+        if not _plugin: _start_plugin()
+        return getattr(_plugin, method)(*args)
+    except Exception, ex:
+        # KMOD can't be trusted after a fatal error.  A new one is
+        # started for the next message.
+        if isinstance(ex, FatalPluginError) or not isinstance(ex, PluginException):
+            try:
+                _stop_plugin()
+            except Exception: pass
+        return ParallelError(str(ex), ex.__class__.__name__)
+
+class ParallelPlugin:
+    """
+    Pool of 'processes' plugins, one per worker process.  The other
+    arguments are those of Plugin.  The attributes of the plugins,
+    such as username, password, kps_host and kps_port, are set from
+    the 'attrs' dictionary.  If kps_host is set, set_server_info() is
+    called once per worker after KMOD is started.
+
+    Each method takes an iterable of messages and returns an iterator
+    over the results, in the same order.  'chunksize' messages are
+    sent to a worker at a time.
+    """
+
+    def __init__(self, processes, kmod_path, attrs = {}, chunksize = 4, **kwargs):
+        self.processes = processes
+        self.chunksize = chunksize
+        self.pool = multiprocessing.Pool(processes, _init_worker, (kmod_path, kwargs, attrs))
+
+    def _map(self, method, jobs):
+        return self.pool.imap(_call, ((method, args) for args in jobs), self.chunksize)
+
+    def sign_mails(self, msgs):
+        return self._map("sign_mail", ((m,) for m in msgs))
+
+    def encrypt_mails(self, msgs):
+        return self._map("encrypt_mail", ((m,) for m in msgs))
+
+    def pod_mails(self, msgs):
+        return self._map("pod_mail", ((m,) for m in msgs))
+
+    def encrypt_and_pod_mails(self, msgs):
+        return self._map("encrypt_and_pod_mail", ((m,) for m in msgs))
+
+    def eval_mails(self, msgs):
+        return self._map("eval_mail", ((m,) for m in msgs))
+
+    def process_mails(self, msgs, pwd = None):
+        return self._map("process_mail", ((m, pwd) for m in msgs))
+
+    def close(self):
+        """
+        Stop the workers and their KMOD once the pending messages are
+        handled.
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,110 @@
+# Password providers for large numbers of non-member recipients.
+#
+# EncryptionPasswordQuery keeps every password in a dictionary built
+# by the caller.  IndexedPasswordQuery reads them from a sqlite
+# database instead, indexed by address, through an LRU cache.  All the
+# passwords KMOD asks for a message are looked up with one query.
+
+import sqlite3, threading
+from Plugin import *
+from Cache import *
+
+__all__ = ['IndexedPasswordQuery']
+
+class IndexedPasswordQuery(EncryptionPasswordQuery):
+    """
+    Passwords stored in the sqlite database at 'path', which is
+    created if needed.  Up to 'cache_size' lookups, found or not, are
+    remembered.
+
+    The database connection isn't pickled, so the query can be sent
+    along with a message to another process, see Parallel.py.  It is
+    shared by the threads of the process, one at a time.
+    """
+
+    # SQLite limits the number of parameters of a statement.
+    batch_size = 500
+
+    def __init__(self, path, cache_size = 10000):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = LRUCache(cache_size)
+        self.__db = None
+        self.__lock = threading.Lock()
+
+    def _db(self):
+        # Called with the lock held.
+        if not self.__db:
+            self.__db = sqlite3.connect(self.path, check_same_thread = False)
+            self.__db.text_factory = str
+            self.__db.execute("create table if not exists passwords "
+                              "(addr text primary key, password text, otut integer)")
+        return self.__db
+
+    def __getstate__(self):
+        return {'path': self.path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['cache_size'])
+
+    def update(self, pwds):
+        """
+        Store the passwords of the dictionary pwds, which has the
+        format given to EncryptionPasswordQuery.
+        """
+        self.__lock.acquire()
+        try:
+            db = self._db()
+            db.executemany("insert or replace into passwords values (?, ?, ?)",
+                           [(a, p, int(o)) for (a, (p, o)) in pwds.items()])
+            db.commit()
+        finally:
+            self.__lock.release()
+        for a in pwds.keys():
+            self.cache.remove(a)
+
+    def getpasses(self, addrs):
+        found = {}
+        missing = []
+        for a in addrs:
+            v = self.cache.get(a, self)
+            if v is self:
+                missing.append(a)
+            elif v != None:
+                found[a] = v
+
+        if not missing: return found
+
+        self.__lock.acquire()
+        try:
+            db = self._db()
+            for i in range(0, len(missing), self.batch_size):
+                batch = missing[i:i + self.batch_size]
+                q = "select addr, password, otut from passwords where addr in (%s)" % ",".join(["?"] * len(batch))
+                for (a, p, o) in db.execute(q, batch):
+                    found[a] = (p, bool(o))
+        finally:
+            self.__lock.release()
+
+        for a in missing:
+            self.cache.put(a, found.get(a))
+        return found
+
+    def getpass(self, addr):
+        r = self.getpasses([addr]).get(addr)
+        if r: return r[0]
+        return None
+
+    def getotut(self, addr):
+        r = self.getpasses([addr]).get(addr)
+        if r: return r[1]
+        return None
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            if self.__db:
+                self.__db.close()
+                self.__db = None
+        finally:
+            self.__lock.release()
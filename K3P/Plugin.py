@@ -13,9 +13,11 @@
 #   this API.  That's one of the killer for using this class for GUI.
 #
 
-import os, shutil, uuid, copy
+import os, shutil, uuid, copy, hashlib
 from Protocol import *
 from Constants import *
+from Metrics import *
+from Logs import *
 
 class PluginException(Exception):
     """
@@ -67,6 +69,19 @@ class EncryptionPasswordQuery:
         else:
             return None
 
+    def getpasses(self, addrs):
+        """
+        Return a dictionary of the addresses of addrs that have a
+        password to (password, give OTUT) tuples.  Override this to
+        look up all the passwords of a message at once.
+        """
+        found = {}
+        for addr in addrs:
+            pwd = self.getpass(addr)
+            if pwd != None:
+                found[addr] = (pwd, self.getotut(addr))
+        return found
+
     def __init__(self, pwds):
         self.pwds = pwds
 
@@ -94,10 +109,10 @@ class MessageEvaluation:
     """
 
     def _eval_field(self, res, struct_field, obj_field):
-        if struct_field in res.__dict__:
-            self.__dict__[obj_field] = (res.__dict__[struct_field] == KMO_FIELD_STATUS_INTACT)
+        if hasattr(res, struct_field):
+            setattr(self, obj_field, getattr(res, struct_field) == KMO_FIELD_STATUS_INTACT)
         else:
-            self.__dict__[obj_field] = None
+            setattr(self, obj_field, None)
 
     def __init__(self, res):
         self.is_valid = res.sig_valid
@@ -222,8 +237,28 @@ class Message:
 
         return m
 
+def _measured(name):
+    """
+    Decorator for Plugin methods which reports the method call to
+    the K3PMetrics object of the plugin, if there is one.
+    """
+    def decorate(method):
+        def measured_method(self, *args, **kwargs):
+            if not self.metrics:
+                return method(self, *args, **kwargs)
+            self.metrics.begin(name)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.end()
+        measured_method.__name__ = method.__name__
+        measured_method.__doc__ = method.__doc__
+        return measured_method
+    return decorate
+
 class Plugin:
-    def __init__(self, kmod_path = None, kmod_host = None, kmod_port = None, kmod_timeout = 1000):
+    def __init__(self, kmod_path = None, kmod_host = None, kmod_port = None, kmod_timeout = 1000,
+                 kmod_unix = False, kmod_template = None):
         self.full_name = None
         self.pod_addr = None
         self.username = None
@@ -235,6 +270,11 @@ class Plugin:
         self.toolinfo = None
 
         self.conn = None
+        self.metrics = None
+
+        # Cache of eval_mail results, such as an LRUCache.  None
+        # disables caching.
+        self.eval_cache = None
 
         # Prepare a KppMua structure.
         self.mua = KppMua()
@@ -260,8 +300,19 @@ class Plugin:
         else:
             # KMOD will connect to the scripts.
             self.conn = K3PConnection(kmod_path = kmod_path,
-                                      kmod_timeout = kmod_timeout)
+                                      kmod_timeout = kmod_timeout,
+                                      kmod_unix = kmod_unix,
+                                      kmod_template = kmod_template)
+
+    def set_metrics(self, metrics):
+        """
+        Attach a K3PMetrics object to the plugin and its connection.
+        Pass None to stop measuring.
+        """
+        self.metrics = metrics
+        self.conn.metrics = metrics
 
+    @_measured("start")
     def start(self):
         """
         Start KMOD and establish a communication link with it.
@@ -281,6 +332,7 @@ class Plugin:
         else:
             raise PluginException("Failed to establish link to KMOD.")
 
+    @_measured("stop")
     def stop(self):
         """
         Wave KMOD goodbye.  No-op if KMOD is already stopped.
@@ -312,6 +364,7 @@ class Plugin:
         si.kps_port_num = self.kps_port
         return si
 
+    @_measured("login_test")
     def login_test(self):
         """
         Do a login test with the server info provided.
@@ -339,6 +392,7 @@ class Plugin:
 
         self.conn.write_instruction(KPP_END_SESSION)
 
+    @_measured("set_server_info")
     def set_server_info(self):
         """
         Set the server info structure to be used by KMOD for the
@@ -410,13 +464,14 @@ class Plugin:
 
         # See if the caller has provided us with passwords.
         if msg.passwords:
+            found = msg.passwords.getpasses([p.recipient for p in missing_pwds])
             for i in range(0, nb):
                 addr = missing_pwds[i].recipient
-                pwd = msg.passwords.getpass(addr)
-                if pwd != None:
+                if addr in found:
+                    (pwd, otut) = found[addr]
                     missing_pwds[i].password = pwd
                     missing_pwds[i].save_pwd = False # FIXME: Password not saved.
-                    missing_pwds[i].give_otut = int(msg.passwords.getotut(addr))
+                    missing_pwds[i].give_otut = int(otut)
                 else:
                     raise PluginException("No password for %s" % addr)
         else:
@@ -495,18 +550,23 @@ class Plugin:
 
         return ret
 
+    @_measured("sign_mail")
     def sign_mail(self, msg):
         return self.__package_mail(KPP_SIGN_MAIL, msg)
 
+    @_measured("encrypt_mail")
     def encrypt_mail(self, msg):
         return self.__package_mail(KPP_SIGN_N_ENCRYPT_MAIL, msg)
 
+    @_measured("pod_mail")
     def pod_mail(self, msg):
         return self.__package_mail(KPP_SIGN_N_POD_MAIL, msg)
 
+    @_measured("encrypt_and_pod_mail")
     def encrypt_and_pod_mail(self, msg):
         return self.__package_mail(KPP_SIGN_N_ENCRYPT_N_POD_MAIL, msg)
 
+    @_measured("process_mail")
     def process_mail(self, msg, pwd = None):
         """
         Returns a ProcessedMessage object.  This will use the
@@ -559,16 +619,70 @@ class Plugin:
                 else:
                     raise PluginException("Processing request returned unknown instruction %s" % i)
         except (K3PException, K3PFatalError), ex:
-            raise FatalPluginException("Protocol error", ex)
+            raise FatalPluginError("Protocol error", ex)
         finally:
             self.conn.write_instruction(KPP_END_SESSION)
 
-    def eval_mail(self, msg):
+    def __read_eval_result(self):
+        """
+        Read the reply to a KPP_EVAL_INCOMING request.
+        """
+        i = self.conn.read_instruction()
+
+        # Check for generic errors.
+        self.__check_errors(i)
+
+        if i.inst == KMO_EVAL_STATUS:
+            # Correct request.  Get evaluation status.
+            n = self.conn.read_integer()
+
+            # FIXME: 2???
+            if n == 2:
+                return None
+            else:
+                mb = self.conn.read_structure(KmoEvalRes)
+                return MessageEvaluation(mb)
+        else:
+            raise PluginException("Don't know what to do.")
+
+    def _eval_cache_key(self, m):
+        """
+        Key of the K3pMail m in eval_cache.  The result of an
+        evaluation depends on the server KMOD talks to as much as on
+        the message.
+        """
+        h = hashlib.sha1(m.to_k3p())
+        h.update("\0%s:%s:%s" % (self.kps_host, self.kps_port, self.username))
+        return h.digest()
+
+    def eval_mail(self, msg, bypass_cache = False):
         """
         Returns a MessageEvaluation object.
+
+        If eval_cache is set, the result of the last evaluation of the
+        same message against the same server is returned when there
+        is one, without asking KMOD.  bypass_cache forces the
+        evaluation, whose result is then cached.
         """
-        m = msg.to_k3p()
+        if self.eval_cache == None:
+            return self._eval_mail(msg.to_k3p())
 
+        m = msg.to_k3p()
+        key = self._eval_cache_key(m)
+        if not bypass_cache:
+            res = self.eval_cache.get(key, self.eval_cache)
+            if not res is self.eval_cache:
+                return copy.deepcopy(res)
+
+        res = self._eval_mail(m)
+        self.eval_cache.put(key, res)
+        return copy.deepcopy(res)
+
+    @_measured("eval_mail")
+    def _eval_mail(self, m):
+        """
+        Evaluate the K3pMail m through KMOD.
+        """
         # Commands
         self.conn.write_instruction(KPP_BEG_SESSION)
         self.conn.write_instruction(KPP_EVAL_INCOMING)
@@ -576,41 +690,112 @@ class Plugin:
         # Write the message.
         self.conn.write_structure(m)
 
-        # Read the result.  Expects KMO_EVAL_STATUS.
-        i = self.conn.read_instruction()
-
         try:
-            # Check for generic errors.
-            self.__check_errors(i)
-
-            if i.inst == KMO_EVAL_STATUS:
-                # Correct request.  Get evaluation status.
-                n = self.conn.read_integer()
-
-                # FIXME: 2???
-                if n == 2:
-                    return None
-                else:
-                    mb = self.conn.read_structure(KmoEvalRes)
-                    return MessageEvaluation(mb)
-            else:
-                raise PluginException("Don't know what to do.")
+            return self.__read_eval_result()
         except (K3PException, K3PFatalError), ex:
-            raise FatalPluginException(ex)
+            raise FatalPluginError("Protocol error", ex)
         finally:
             self.conn.write_instruction(KPP_END_SESSION)
 
-    def save_logs(self, destdir):
+    def eval_mails(self, msgs, window = 8):
+        """
+        Evaluate the messages of the iterable msgs, yielding what
+        eval_mail would return for each of them, in order.
+
+        KMOD handles the requests one at a time, but up to 'window'
+        of them are written ahead of the replies, in a single write,
+        so KMOD doesn't wait for us between messages.  Keep the
+        window small enough for the replies in flight to fit in the
+        socket buffers.
+
+        If the evaluation of a message fails, the replies to the
+        messages already sent are read and dropped before raising.
+        The same is done if the caller stops iterating early.
+        """
+        it = iter(msgs)
+        pending = 0
+        done = False
+
+        if self.metrics: self.metrics.begin("eval_mails")
+        try:
+            try:
+                while True:
+                    # Send as many requests as the window allows.
+                    self.conn.hold_flush = True
+                    try:
+                        while not done and pending < window:
+                            try:
+                                msg = it.next()
+                            except StopIteration:
+                                done = True
+                                break
+                            m = msg.to_k3p()
+                            self.conn.write_instruction(KPP_BEG_SESSION)
+                            self.conn.write_instruction(KPP_EVAL_INCOMING)
+                            self.conn.write_structure(m)
+                            self.conn.write_instruction(KPP_END_SESSION)
+                            pending += 1
+                    finally:
+                        self.conn.hold_flush = False
+                    self.conn.flush()
+
+                    if pending == 0: break
+                    pending -= 1
+                    yield self.__read_eval_result()
+            except (K3PException, K3PFatalError), ex:
+                # The connection is out of sync, there is no draining
+                # it.
+                pending = 0
+                raise FatalPluginError("Protocol error", ex)
+        finally:
+            try:
+                while pending > 0:
+                    pending -= 1
+                    try:
+                        self.__read_eval_result()
+                    except (PluginException, FatalPluginError): pass
+            finally:
+                if self.metrics: self.metrics.end()
+
+    def save_template(self, path):
+        """
+        Stop KMOD and save its directory to path, which must not
+        exist, for use as the kmod_template of other plugins.  This is
+        meant to be called once KMOD is configured, typically after
+        set_server_info(), so that the plugins created from the
+        template skip that setup.  start() can be called again
+        afterward.
+        """
+        if os.path.exists(path):
+            raise PluginException("%s already exists." % path)
+        if not self.conn.kmod_dir:
+            raise PluginException("KMOD was never started.")
+        self.stop()
+
+        # Build the template aside so that a partial copy is never
+        # used.
+        tmp_path = "%s.%d" % (path, os.getpid())
+        os.mkdir(tmp_path)
+        try:
+            clone_kmod_dir(self.conn.kmod_dir, tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            shutil.rmtree(tmp_path, True)
+            raise
+
+    def save_logs(self, destdir, prefix = None):
         """
-        Copy all the content in the KMOD log directory to destdir.
+        Archive the KMOD log directory to destdir, under a unique name
+        starting with prefix, such as the test ID.  The logs are moved
+        out of the KMOD directory right away and compressed in the
+        background, see Logs.py.  Return the path of the archive.
         Won't work if KMOD is running.
         """
         if not self.conn.kmod_dir: return # No op.  There will be no logs in this case.        
         if self.conn.running():
             raise PluginException("Can't save logs while kmod is running")
-        if not os.path.exists(destdir):
-            os.mkdir(destdir)
         logs_path = os.path.join(self.conn.kmod_dir, "kmod_logs")
-        for logfile in os.listdir(logs_path):
-            logfile_path = os.path.join(logs_path, logfile)
-            shutil.copyfile(logfile_path, os.path.join(destdir, logfile))
+        if not os.path.exists(logs_path): return
+        # Stage next to the KMOD directory so that moving the logs
+        # is a rename.
+        return log_archiver(destdir).submit(logs_path, prefix, os.path.dirname(self.conn.kmod_dir))
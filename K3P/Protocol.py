@@ -6,7 +6,11 @@
 #
 # Author: Francois-Denis Gonthier
 
-import os, sys, socket, tempfile, time, inspect, shutil, signal, select
+import os, sys, socket, tempfile, time, inspect, shutil, signal, select, threading, atexit, fcntl, itertools
+import subprocess
+from StringIO import StringIO
+from KNP.Transport import *
+from ProfK.Clock import monotonic
 from Constants import *
 
 class K3PException(Exception):
@@ -33,42 +37,102 @@ class K3PClientFatalError(K3PFatalError):
     """
     pass
 
-class _K3PStructure:
+class _K3PStructureType(type):
+    """
+    Metaclass of the K3P structures.  The fields listed in _attrs are
+    the slots of the class, so that structures have no __dict__.
+    """
+
+    def __new__(mcs, name, bases, dct):
+        if not '__slots__' in dct:
+            dct['__slots__'] = tuple([v[0] for v in dct.get('_attrs', [])])
+        return type.__new__(mcs, name, bases, dct)
+
+class _K3PStructure(object):
     """
     A structure is a set of many K3P elements.
     """
 
-    def _k3p_to_element(self, typ, key, el, args):
+    __metaclass__ = _K3PStructureType
+    __slots__ = ('nelements',)
+    _attrs = []
+
+    def _k3p_to_element(self, typ, key, els, pos):
         """
-        Convert a raw K3P element to a Python native value
+        Convert the raw K3P element(s) starting at els[pos] to a
+        Python native value.  Return the value and the position of
+        the next element.
         """
         is_struct = inspect.isclass(typ) and issubclass(typ, _K3PStructure)
         is_native = type(typ) is str
-        nb = 1
 
         if is_struct:
-            obj = typ(args)
-            self.__dict__[key] = obj
-            nb = obj.nelements
+            obj = typ()
+            return (obj, obj._from_elements(els, pos))
 
         elif is_native:
+            if pos >= len(els):
+                raise K3PClientFatalError("Missing elements for structure %s" % self.__class__)
+            el = els[pos]
             if typ == 'S':
                 if el.__class__ != K3PString:
                     s = "Incorrect type received for structure %s element %s"
                     s += " Expected String, got %s"
                     raise K3PClientFatalError(s % (self.__class__, key, el.name()))
                 else:
-                    #print key + " = " + el.val
-                    self.__dict__[key] = el.val
+                    return (el.val, pos + 1)
             elif typ == 'I':
                 if el.__class__ != K3PInteger:
                     s = "Incorrect type received for structure %s element %s."
                     s += " Expected type Integer, got %s"
                     raise K3PClientFatalError(s % (self.__class__, key, el.name()))
                 else:
-                    #print key + " = " + str(el.val)
-                    self.__dict__[key] = el.val
-        return nb
+                    return (el.val, pos + 1)
+        return (None, pos + 1)
+
+    def _from_elements(self, els, pos):
+        """
+        Set the fields from the elements of the list els, starting at
+        position pos.  Return the position of the first element not
+        used.
+        """
+        start = pos
+        for v in self.__class__._attrs:
+            (key, typ) = v
+
+            is_array = type(typ) is tuple
+            is_struct = inspect.isclass(typ) and issubclass(typ, _K3PStructure)
+            is_native = type(typ) is str
+
+            # Check for arrays.
+            if is_array:
+                (nb_attr, typ) = typ
+
+                # Handle arrays.  Each item starts where the
+                # previous one ended.
+                items = []
+                nb = getattr(self, nb_attr)
+                if nb:
+                    for i in range(0, nb):
+                        (el, pos) = self._k3p_to_element(typ, key, els, pos)
+                        items.append(el)
+                setattr(self, key, items)
+
+            # Check for structure or ordinary types.
+            elif is_struct or is_native:
+                (el, pos) = self._k3p_to_element(typ, key, els, pos)
+                setattr(self, key, el)
+
+        self.nelements = pos - start
+        return pos
+
+    def __getstate__(self):
+        return dict([(v[0], getattr(self, v[0])) for v in self.__class__._attrs])
+
+    def __setstate__(self, state):
+        self.__init__()
+        for (key, val) in state.items():
+            setattr(self, key, val)
 
     def __init__(self, *args):
         """
@@ -83,48 +147,23 @@ class _K3PStructure:
         for v in self.__class__._attrs:
             (key, typ) = v
             if inspect.isclass(typ) and issubclass(typ, _K3PStructure):
-                self.__dict__[key] = typ()
+                setattr(self, key, typ())
             elif type(typ) is tuple:
-                self.__dict__[key] = []
+                setattr(self, key, [])
             elif type(typ) is str:
-                self.__dict__[key] = None
+                setattr(self, key, None)
             else:
                 raise K3PClientFatalError("Incorrect structure definition")
 
         if args:
-            args = list(*args)
-
-            for v in self.__class__._attrs:
-                (key, typ) = v
-                el = args[0]
-
-                is_array = type(typ) is tuple
-                is_struct = inspect.isclass(typ) and issubclass(typ, _K3PStructure)
-                is_native = type(typ) is str
-                nb = 0
-
-                # Check for arrays.
-                if is_array:
-                    (nb_attr, typ) = typ
-
-                    # Handle arrays.
-                    if nb_attr in self.__dict__ and self.__dict__[nb_attr]:
-                        for i in range(0, self.__dict__[nb_attr]):
-                            nb += self._k3p_to_element(typ, key, el, args)
-
-                # Check for structure or ordinary types.
-                elif is_struct or is_native:
-                    nb = self._k3p_to_element(typ, key, el, args)
-
-                self.nelements += nb
-                for i in range(0, nb): del args[0]
+            self._from_elements(args[0], 0)
 
     def __str__(self):
         sl = []
         for v in self.__class__._attrs:
             (key, typ) = v
-            if key in self.__dict__:
-                sl.append("%s: %s" % (key, str(self.__dict__[key])))
+            if hasattr(self, key):
+                sl.append("%s: %s" % (key, str(getattr(self, key))))
             else:
                 if typ == "S":
                     sl.append("%s: %s" % (key, "\"\""))
@@ -132,27 +171,31 @@ class _K3PStructure:
                     sl.append("%s: %s" % (key, "0"))
         return " ".join(sl)
 
-    def _elements_to_k3p(self, typ, key):
+    def _elements_to_k3p(self, typ, key, index = None):
+        """
+        Serialize the element 'key'.  If 'index' is not None, the
+        element is an array and only the item at 'index' is
+        serialized.
+        """
         s = ""
+        val = None
+        if hasattr(self, key):
+            val = getattr(self, key)
+            if index != None: val = val[index]
+
         # Substructure types.
         if inspect.isclass(typ) and issubclass(typ, _K3PStructure):
-            if key in self.__dict__:
-                s += self.__dict__[key].to_k3p()
+            if val != None:
+                s += val.to_k3p()
             else:
                 raise K3PClientFatalError("Don't know what to do with null structures.")
 
         # Simple types.
         elif type(typ) is str:
             if typ == 'S':
-                if key in self.__dict__:
-                    s += K3PString(self.__dict__[key]).to_k3p()
-                else:
-                    s += K3PString("").to_k3p()
+                s += K3PString(val).to_k3p()
             elif typ == 'I':
-                if key in self.__dict__:
-                    s += K3PInteger(self.__dict__[key]).to_k3p()
-                else:
-                    s += K3PInteger(0).to_k3p()
+                s += K3PInteger(val).to_k3p()
         return s
 
     def to_k3p(self):
@@ -169,9 +212,10 @@ class _K3PStructure:
                 (nb_attr, typ) = typ
 
                 # Handle arrays as a set of native type.
-                if nb_attr in self.__dict__ and self.__dict__[nb_attr]:
-                    for i in range(0, self.__dict__[nb_attr]):
-                        s += self._elements_to_k3p(typ, key)
+                nb = getattr(self, nb_attr, None)
+                if nb:
+                    for i in range(0, nb):
+                        s += self._elements_to_k3p(typ, key, i)
 
             # Handle structures and simple types
             elif is_struct or is_native:
@@ -301,7 +345,9 @@ class KmoProcessNack(_K3PStructure):
     _attrs = [('error', 'I'),
               ('error_msg', 'S')]
 
-class _K3PElement:
+class _K3PElement(object):
+    __slots__ = ()
+
     def parse(str):
         pass
     parse = staticmethod(parse)
@@ -319,6 +365,8 @@ class _K3PElement:
     def name(self): pass
 
 class K3PInstruction(_K3PElement):
+    __slots__ = ('inst',)
+
     def __init__(self, inst):
         self.inst = int(inst)
 
@@ -331,6 +379,8 @@ class K3PInstruction(_K3PElement):
         return "INSTR 0x%08x" % self.inst
 
 class K3PInteger(_K3PElement):
+    __slots__ = ('val',)
+
     def __init__(self, val):
         if val:
             self.val = int(val)
@@ -349,6 +399,8 @@ class K3PInteger(_K3PElement):
         return str(self.val)
 
 class K3PString(_K3PElement):
+    __slots__ = ('val',)
+
     def __init__(self, val):
         if val:
             self.val = val
@@ -361,9 +413,172 @@ class K3PString(_K3PElement):
         return "STR%u>%s" % (len(self.val), self.val)
 
     def __str__(self):
-        return self.val
+        return str(self.val)
+
+class K3PSpooledString:
+    """
+    Value of a string element too large to be kept in memory, stored
+    in an anonymous temporary file.  It compares with strings and
+    other spooled strings, and str() loads it.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, f, size):
+        self.file = f
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def chunks(self):
+        """
+        Iterate over the content, chunk_size bytes at a time.
+        """
+        self.file.seek(0)
+        n = self.size
+        while n > 0:
+            b = self.file.read(min(n, self.chunk_size))
+            if not b: break
+            n -= len(b)
+            yield b
+
+    def read(self):
+        return "".join(self.chunks())
+
+    def __str__(self):
+        return self.read()
+
+    def __deepcopy__(self, memo):
+        # The content never changes, and the file can't be copied.
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, (str, K3PSpooledString)): return NotImplemented
+        if len(other) != self.size: return False
+        if other is self: return True
+        if isinstance(other, K3PSpooledString):
+            # Both files are read a chunk at a time, and the chunks of
+            # two strings of the same size have the same sizes.
+            for (a, b) in itertools.izip(self.chunks(), other.chunks()):
+                if a != b: return False
+            return True
+        pos = 0
+        for b in self.chunks():
+            if other[pos:pos + len(b)] != b: return False
+            pos += len(b)
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+# KMOD instances started by K3PConnection objects of this process and
+# not yet stopped, by PID.  Each has its own directory and port so
+# any number of them can run side by side.
+_kmod_instances = {}
+# Reentrant, since KMOD may be killed from a signal handler.  See
+# Parallel.py.
+_kmod_instances_lock = threading.RLock()
+
+# Held while creating the pipes inherited by KMOD.  See
+# _connect_kmod_connect.
+_fork_lock = threading.Lock()
+
+def kmod_instances():
+    """
+    Return a list of (pid, address, kmod_dir) for the KMOD instances
+    currently running.  address is a port number or the path of a
+    Unix domain socket.
+    """
+    _kmod_instances_lock.acquire()
+    try:
+        return _kmod_instances.values()
+    finally:
+        _kmod_instances_lock.release()
+
+def _register_kmod(pid, address, kmod_dir):
+    _kmod_instances_lock.acquire()
+    try:
+        _kmod_instances[pid] = (pid, address, kmod_dir)
+    finally:
+        _kmod_instances_lock.release()
+
+def _unregister_kmod(pid):
+    _kmod_instances_lock.acquire()
+    try:
+        if pid in _kmod_instances: del _kmod_instances[pid]
+    finally:
+        _kmod_instances_lock.release()
+
+def stop_kmod_instances():
+    """
+    Kill the KMOD instances still running.  This is done at exit so
+    that crashed tests don't leave KMOD processes behind.
+    """
+    for (pid, _, _) in kmod_instances():
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError: pass
+        _unregister_kmod(pid)
+
+atexit.register(stop_kmod_instances)
+
+# Files of a KMOD directory that belong to one run of KMOD and are
+# not copied in templates.
+_kmod_dir_transient = ["kmod_logs", "connect_secret", "kmod.sock"]
+
+def clone_kmod_dir(src, dst):
+    """
+    Copy the persistent content of the KMOD directory src into dst,
+    which must exist.  Files are reflinked when the file system
+    supports it, so the copy is nearly free.  Hard links can't be
+    used since KMOD updates its database in place.
+    """
+    names = [n for n in os.listdir(src) if not n in _kmod_dir_transient]
+    if not names: return
+
+    try:
+        devnull = open(os.devnull, "w")
+        try:
+            ret = subprocess.call(["cp", "-a", "--reflink=auto"] +
+                                  [os.path.join(src, n) for n in names] + [dst],
+                                  stderr = devnull)
+        finally:
+            devnull.close()
+        if ret == 0: return
+    except OSError: pass
+
+    # No GNU cp.
+    for n in names:
+        s = os.path.join(src, n)
+        d = os.path.join(dst, n)
+        if os.path.isdir(s):
+            if os.path.exists(d): shutil.rmtree(d)
+            shutil.copytree(s, d, True)
+        else:
+            shutil.copy2(s, d)
 
 class K3PConnection:
+    def _now(self):
+        if self.metrics: return self.metrics.clock()
+        return 0
+
+    def _measure(self, phase, start):
+        """
+        Account the time elapsed since 'start' to a phase of the
+        current call.
+        """
+        if self.metrics: self.metrics.add_time(phase, self.metrics.clock() - start)
+
+    def _read_kmod(self, n):
+        """
+        Read n bytes from KMOD, counting them.
+        """
+        b = self.kmod.read(n)
+        self.bytes_in += len(b)
+        return b
+
     def read_instruction(self):
         """
         Read one element from KMOD, asserting that it is of instruction type.
@@ -405,7 +620,10 @@ class K3PConnection:
             if type(typ) is tuple:
                 (nb_els, typ) = typ
 
-                for i in range(0, crap[nb_els]):
+                n = crap[nb_els]
+                if n < 0 or n > self.max_array_elements:
+                    raise K3PFatalError("Array of %d elements exceeds the limit of %d elements" % (n, self.max_array_elements))
+                for i in xrange(0, n):
                     els.extend(self._read_structure_elements(typ))
 
             # Read structure.
@@ -434,9 +652,66 @@ class K3PConnection:
     def read_structure(self, struct_class):
         """
         Read a K3P structure from KMOD.  'struct_class' is the class
-        of the structure you want to read from KMOD.
+        of the structure you want to read from KMOD.  Its strings
+        must not add up to more than max_structure_size bytes, each
+        element counting for element_cost bytes besides its string.
+        """
+        self._budget = self.max_structure_size
+        try:
+            els = self._read_structure_elements(struct_class)
+        finally:
+            self._budget = None
+        t = self._now()
+        st = struct_class(els)
+        self._measure("decode", t)
+        return st
+
+    def _read_exactly(self, n):
+        b = self._read_kmod(n)
+        if len(b) != n:
+            raise K3PFatalError("Connection to KMOD closed")
+        return b
+
+    def _read_number(self, what):
+        """
+        Read the digits of an integer or string length, up to the
+        closing '>'.
         """
-        return struct_class(self._read_structure_elements(struct_class))
+        s = ""
+        while True:
+            c = self._read_exactly(1)
+            if c == ">": break
+            s += c
+            if len(s) > self.max_digits:
+                raise K3PFatalError("%s too long: %s..." % (what, s))
+        try:
+            return int(s)
+        except ValueError:
+            raise K3PFatalError("Invalid %s: %r" % (what, s))
+
+    def _read_string(self, sz):
+        """
+        Read a string body of sz bytes, in chunks.  Strings above
+        spool_size are written to a temporary file as they arrive.
+        """
+        limit = self.max_element_size
+        if self._budget != None:
+            limit = min(limit, self._budget)
+        if sz < 0 or sz > limit:
+            raise K3PFatalError("String of %d bytes exceeds the limit of %d bytes" % (sz, limit))
+        if self._budget != None:
+            self._budget -= sz
+
+        if sz <= self.spool_size:
+            return self._read_exactly(sz)
+
+        f = tempfile.TemporaryFile()
+        n = sz
+        while n > 0:
+            b = self._read_exactly(min(n, K3PSpooledString.chunk_size))
+            f.write(b)
+            n -= len(b)
+        return K3PSpooledString(f, sz)
 
     def read(self, nb_el):
         """
@@ -444,38 +719,42 @@ class K3PConnection:
         list of native elements.
         """
         if not self.kmod: raise K3PClientFatalError("Not started")
-        # NOTE: This function is knowingly low-tech, I don't believe
-        # it's necessary to do any clever buffering in test scripts.
         els = []
+        nin = self.bytes_in
         for i in range(0, nb_el):
-            # Read 3 bytes, check what to expect next.
-            typ = self.kmod.read(3)
+            # Read 3 bytes, check what to expect next.  The first read
+            # after a write is the wait for KMOD to reply.
+            t = self._now()
+            typ = self._read_kmod(3)
+            if self.reply_pending:
+                self._measure("wait", t)
+                self.reply_pending = False
+                t = self._now()
+
+            if self._budget != None:
+                if self._budget < self.element_cost:
+                    raise K3PFatalError("Structure exceeds the limit of %d bytes" % self.max_structure_size)
+                self._budget -= self.element_cost
 
             if typ == 'INT':
-                # Read 1 char until the next >
-                s = ""
-                while True:
-                    c = self.kmod.read(1)
-                    if c != ">": s += c
-                    else: break
-                els += [K3PInteger(int(s))]
+                els += [K3PInteger(self._read_number("Integer"))]
             elif typ == 'STR':
-                # Read the lenght of the string we can expect.
-                s = ""
-                while True:
-                    c = self.kmod.read(1)
-                    if c != ">": s += c
-                    else: break
-                sz = int(s)
-                s = ""
-                for i in range(0, sz): s += self.kmod.read(1)
-                els += [K3PString(s)]
+                sz = self._read_number("String length")
+                els += [K3PString(self._read_string(sz))]
             elif typ == 'INS':
                 # Read 8 bytes.
-                inst = self.kmod.read(8)
-                els += [K3PInstruction(int(inst, 16))]
+                inst = self._read_exactly(8)
+                try:
+                    els += [K3PInstruction(int(inst, 16))]
+                except ValueError:
+                    raise K3PFatalError("Invalid instruction: %r" % inst)
+            elif typ == '':
+                raise K3PFatalError("Connection to KMOD closed")
             else:
-                raise K3PFatalError("Weird stuff received: %s" % typ)
+                raise K3PFatalError("Weird stuff received: %r" % typ)
+            self._measure("read", t)
+
+        if self.metrics: self.metrics.add_bytes(0, self.bytes_in - nin)
         return els
 
     def write_integer(self, i):
@@ -508,46 +787,70 @@ class K3PConnection:
         the socket file if self.hold_flush isn't False.
         """
         if not self.kmod: raise K3PClientFatalError("Not started")
+        t = self._now()
+        buf = obj.to_k3p()
+        self._measure("encode", t)
+
+        t = self._now()
+        try:
+            self.kmod.write(buf)
+            if not self.hold_flush: self.kmod.flush()
+        except socket.error, ex:
+            raise K3PFatalError("Write error")
+        self._measure("write", t)
+
+        self.bytes_out += len(buf)
+        if self.metrics: self.metrics.add_bytes(len(buf), 0)
+        self.reply_pending = True
+
+    def flush(self):
+        """
+        Send what was written while hold_flush was set.
+        """
+        if not self.kmod: raise K3PClientFatalError("Not started")
+        t = self._now()
         try:
-            self.kmod.write(obj.to_k3p())
             self.kmod.flush()
         except socket.error, ex:
             raise K3PFatalError("Write error")
+        self._measure("write", t)
 
     def close(self):
         """
         Close the socket connected to KMOD.
         """
         try:
-            if self.kmod_sock:
-                self.kmod_sock.shutdown(socket.SHUT_RDWR)
-                self.kmod_sock.close()
+            if self.transport:
+                self.transport.close()
         except socket.error, ex: pass
         finally:
-            self.kmod_sock = None
+            self.transport = None
             self.kmod = None
 
         if self.kmod_pid:
-            # Makes sure KMOD is down.
-            if self.kmod_pid:
+            # Makes sure KMOD is down.  It is already gone if
+            # stop_kmod_instances() ran first.
+            try:
                 os.kill(self.kmod_pid, signal.SIGTERM)
 
-            # Wait for kmod to die.
-            os.waitpid(self.kmod_pid, 0)
+                # Wait for kmod to die.
+                os.waitpid(self.kmod_pid, 0)
+            except OSError: pass
+            _unregister_kmod(self.kmod_pid)
             self.kmod_pid = None
 
     def running(self):
         """
         Return true of the KMOD socket is still alive.
         """
-        return (self.kmod_sock != None)
+        return (self.transport != None)
 
     def clean(self):
         """
         Remove the temporary directory.  This will disconnect the kmod
         socket if not done already.
         """
-        if self.running(): self.close()
+        if self.running() or self.kmod_pid: self.close()
         
         # Integrally remove the temporary directory.
         if self.kmod_dir:
@@ -560,87 +863,173 @@ class K3PConnection:
         """
         self.clean()
 
+    def _kmod_listen(self):
+        """
+        Return the socket KMOD is asked to connect to, and the
+        arguments telling KMOD where it is.
+        """
+        if self.kmod_unix:
+            path = os.path.join(self.kmod_dir, "kmod.sock")
+            if os.path.exists(path): os.unlink(path)
+            srv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            srv_sock.bind(path)
+            self.kmod_addr = path
+            return (srv_sock, ["-u", path])
+        else:
+            # Port 0 lets the system pick a free port.
+            srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            srv_sock.bind((self.kmod_host, self.kmod_port))
+            (_, self.kmod_addr) = srv_sock.getsockname()
+            return (srv_sock, ["-p", str(self.kmod_addr)])
+
+    def _wait_kmod(self, srv_sock, status_fd, deadline):
+        """
+        Wait until KMOD connects to srv_sock, or fails to start.  KMOD
+        inherits the write end of the status_fd pipe, so status_fd
+        becomes readable as soon as KMOD exits, or if the child
+        reports that it could not execute KMOD.
+        """
+        while True:
+            left = deadline - monotonic()
+            if left <= 0:
+                raise K3PException("Timeout connecting to KMOD (timeout is %d ms)." % self.timeout)
+            (rd, _, _) = select.select([srv_sock, status_fd], [], [], left)
+
+            if srv_sock in rd:
+                (sock, _) = srv_sock.accept()
+                return sock
+            elif status_fd in rd:
+                err = os.read(status_fd, 16)
+                (_, status) = os.waitpid(self.kmod_pid, 0)
+                _unregister_kmod(self.kmod_pid)
+                self.kmod_pid = None
+                if err:
+                    raise K3PException("Failed to execute %s: %s" %
+                                       (self.kmod_path, os.strerror(int(err))))
+                if os.WIFSIGNALED(status):
+                    raise K3PException("KMOD killed by signal %d on startup." % os.WTERMSIG(status))
+                raise K3PException("KMOD exited with status %d on startup." % os.WEXITSTATUS(status))
+
     def _connect_kmod_connect(self):
         """
         This method handles the automatic connection of KMOD to the
         plugin.
         """
-        srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        srv_sock.bind((self.kmod_host, self.kmod_port))
+        t = monotonic()
+        deadline = t + float(self.timeout) / 1000
+        (srv_sock, addr_args) = self._kmod_listen()
         srv_sock.listen(1)
 
-        # Fork for kmod.
-        self.kmod_pid = os.fork()
+        # The status pipe must not leak in KMOD instances started
+        # concurrently by other threads, so it is close-on-exec
+        # except in our own child.
+        _fork_lock.acquire()
+        try:
+            (status_r, status_w) = os.pipe()
+            for fd in (status_r, status_w):
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+            # Fork for kmod.
+            self.kmod_pid = os.fork()
+        finally:
+            _fork_lock.release()
 
         if self.kmod_pid == 0:
-            # Client side.  Execute KMOD.
+            # Client side.  Execute KMOD, or report why we couldn't.
+            try:
+                try:
+                    srv_sock.close()
+                    fcntl.fcntl(status_w, fcntl.F_SETFD, 0)
+                    args = [self.kmod_path,
+                            "-C", self.__connect_mode,
+                            "-l", "3"] + addr_args + ["-k", self.kmod_dir]
+                    os.execve(self.kmod_path, args, {})
+                except OSError, ex:
+                    os.write(status_w, str(ex.errno))
+            finally:
+                os._exit(127)
+
+        # Parent side.  Wait for KMOD to connect.
+        _register_kmod(self.kmod_pid, self.kmod_addr, self.kmod_dir)
+        os.close(status_w)
+        try:
+            sock = self._wait_kmod(srv_sock, status_r, deadline)
+        finally:
             srv_sock.close()
+            os.close(status_r)
 
-            args = [self.kmod_path,
-                    "-C", self.__connect_mode,
-                    "-l", "3",
-                    "-p", str(self.kmod_port),
-                    "-k", self.kmod_dir]
-            os.execve(self.kmod_path, args, {})
-            
-        elif self.kmod_pid > 0:           
-            # Parent side.  Wait for KMOD to connect.
-            (rd, _, er) = select.select([srv_sock.fileno()],
-                                       [],
-                                       [srv_sock.fileno()],
-                                       float(self.timeout) / 1000)
-            if len(er) > 0:
-                raise K3PException("Failed to connect to KMOD.")
-            elif len(rd) > 0:
-                (self.kmod_sock, _) = srv_sock.accept()
-            else:
-                raise K3PException("Timeout connecting to KMOD (timeout is %d ms)." % self.timeout)
-
-            self.kmod = self.kmod_sock.makefile()
-            srv_sock.close()
+        if self.kmod_unix:
+            self.transport = UnixTransport(sock = sock)
+        else:
+            self.transport = TCPTransport(sock = sock)
+        self.kmod = self.transport.makefile()
 
-            secret_file = os.path.join(self.kmod_dir, "connect_secret")
-            secret_stuff = None
+        secret_file = os.path.join(self.kmod_dir, "connect_secret")
+        secret_stuff = None
 
-            if os.path.exists(secret_file):
-                secret_file = open(secret_file, "r")
-                secret_stuff = secret_file.read()
-                secret_file.close()
+        if os.path.exists(secret_file):
+            secret_file = open(secret_file, "r")
+            secret_stuff = secret_file.read()
+            secret_file.close()
 
+            try:
+                self.transport.settimeout(max(deadline - monotonic(), 0.001))
                 kmod_secret_stuff = self.kmod.read(len(secret_stuff))
-                if secret_stuff != kmod_secret_stuff:
-                    raise K3PException("Secret handshake with KMOD failed.")
-            else:
-                raise K3PException("Failed to complete the connexion with KMOD.")
+                self.transport.settimeout(None)
+            except socket.timeout:
+                raise K3PException("Timeout waiting for the KMOD secret.")
+            if secret_stuff != kmod_secret_stuff:
+                raise K3PException("Secret handshake with KMOD failed.")
+        else:
+            raise K3PException("Failed to complete the connexion with KMOD.")
+
+        self.startup_time = monotonic() - t
+
+    def attach(self, kmod_sock):
+        """
+        Use an already connected socket or transport to talk K3P.
+        This is meant for the KMOD side of a connection.
+        """
+        if isinstance(kmod_sock, Transport):
+            self.transport = kmod_sock
         else:
-            raise K3PException("Failed to fork to start kmod.")
+            self.transport = SocketTransport(kmod_sock)
+        self.kmod = self.transport.makefile()
+        self.reply_pending = False
 
     def _connect_kpp_connect(self):
         """
         This handles connection of the plugin to KMOD.
         """
         # FIXME: Better exception handling.
-        self.kmod_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.kmod_sock.settimeout(float(self.timeout) / 1000)
-        self.kmod_sock.connect((self.kmod_host, self.kmod_port))
-        self.kmod = self.kmod_sock.makefile()
+        if not self.transport:
+            self.transport = TCPTransport(self.kmod_host, self.kmod_port)
+        self.transport.settimeout(float(self.timeout) / 1000)
+        self.transport.connect()
+        self.kmod = self.transport.makefile()
 
     def connect(self):
         """
         Start kmod and return a socket connected to it.
         """
-        if self.kmod_sock: raise K3PException("Cannot connect twice.")
+        if self.kmod: raise K3PException("Cannot connect twice.")
 
         if not self.kmod_dir:
             self.kmod_dir = tempfile.mkdtemp()
+            if self.kmod_template:
+                clone_kmod_dir(self.kmod_template, self.kmod_dir)
 
+        t = self._now()
         if self.__connect_mode == "kmod_connect":
             self._connect_kmod_connect()
         elif self.__connect_mode == "kpp_connect":
             self._connect_kpp_connect()
+        self._measure("connect", t)
+        self.reply_pending = False
 
-    def __init__(self, kmod_path = None, kmod_host = None, kmod_port = None, kmod_timeout = 1000):
+    def __init__(self, kmod_path = None, kmod_host = None, kmod_port = None, kmod_timeout = 1000,
+                 transport = None, kmod_unix = False, kmod_template = None):
         """
         Initialize basic stuff.  kmod_path is the path to the kmod
         executable.
@@ -649,16 +1038,32 @@ class K3PConnection:
         kmod_port is the port to connect to.  If kmod_host and
         kmod_port are both defined, this plugin will attempt to
         connect to KMOD.  If both are None, then we have n
+
+        When KMOD connects to the plugin, kmod_port is the port to
+        listen on.  By default, the system picks a free one, which is
+        then available in kmod_addr and passed to KMOD with -p.
+
+        transport is a Transport already leading to a running KMOD,
+        see KNP/Transport.py.  It is connected by connect().
+
+        If kmod_unix is true, the KMOD started by the plugin connects
+        back through a Unix domain socket in the KMOD directory
+        instead of TCP.  KMOD receives its path with -u instead of
+        the port with -p.
+
+        kmod_template is a KMOD directory prepared beforehand, see
+        Plugin.save_template().  Each new KMOD directory starts as a
+        copy of it instead of being empty.
         """       
         # Check the connection mode.
-        if kmod_host and kmod_port:
+        if transport or (kmod_host and kmod_port):
             self.__connect_mode = "kpp_connect"
         else:
             self.__connect_mode = "kmod_connect"
 
         # Check for the KMOD port.
         if not kmod_port:
-            self.kmod_port = 29999
+            self.kmod_port = 0
         else:
             self.kmod_port = int(kmod_port)
 
@@ -670,6 +1075,49 @@ class K3PConnection:
 
         self.timeout = kmod_timeout
         self.kmod_path = kmod_path
+        self.kmod_unix = kmod_unix
+        self.kmod_addr = None
+        self.kmod_template = kmod_template
+
+        # Seconds between starting KMOD and the end of the secret
+        # handshake, set by connect() in kmod_connect mode.
+        self.startup_time = None
         self.kmod_dir = None
-        self.kmod_sock = None
         self.kmod_pid = None
+        self.transport = transport
+        self.kmod = None
+
+        # Instrumentation.  See Metrics.py.
+        self.metrics = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reply_pending = False
+
+        # If true, write() buffers until flush() is called.
+        self.hold_flush = False
+
+        # Limits on what KMOD sends, in bytes.  Strings larger than
+        # spool_size are kept in temporary files, see
+        # K3PSpooledString.
+        self.max_element_size = 256 << 20
+        self.max_structure_size = 512 << 20
+        self.spool_size = 16 << 20
+        self.max_digits = 20
+        self._budget = None
+
+        # Limits on the number of elements of a structure.  Elements
+        # are also charged element_cost bytes, about what they take
+        # in memory, against max_structure_size.
+        self.max_array_elements = 1 << 20
+        self.element_cost = 64
+
+def k3p_decode(buf, struct_class):
+    """
+    Decode a K3P structure of class struct_class held in memory.
+    """
+    conn = K3PConnection()
+    conn.kmod = StringIO(buf)
+    try:
+        return conn.read_structure(struct_class)
+    finally:
+        conn.kmod = None
@@ -1 +1,7 @@
 from Plugin import *
+from Protocol import *
+from Metrics import *
+from Logs import *
+from Parallel import *
+from Cache import *
+from Passwords import *
@@ -1,8 +1,9 @@
-import socket, struct, inspect, select
-from gnutls.connection import *
-from gnutls.constants import *
-from gnutls.errors import *
+import socket, struct, inspect, select, tempfile, mmap
+from array import array
+from ProfK.Clock import monotonic
 from Constants import *
+from Stats import *
+from Transport import *
 
 class KNPException(Exception):
     """
@@ -19,97 +20,300 @@ class KNPClientFatalError(KNPFatalError):
     """
     pass
 
-class _KNPStructure:
+class _KNPStructureType(type):
     """
+    Metaclass of the KNP structures.  The fields listed in _attrs are
+    the slots of the class, so that structures have no __dict__.
     """
 
-    def _knp_to_element(self, typ, key, el, args):
+    def __new__(mcs, name, bases, dct):
+        if not '__slots__' in dct:
+            dct['__slots__'] = tuple([v[0] for v in dct.get('_attrs', [])])
+        return type.__new__(mcs, name, bases, dct)
+
+# array typecodes used for arrays of KNP integers.  Python 2 has no
+# 'Q': 'L' is used if it is 64 bits wide, a list otherwise.
+_knp_array_codes = {}
+for (typ, code, size) in [('I', 'I', 4), ('L', 'L', 8)]:
+    if array(code).itemsize >= size:
+        _knp_array_codes[typ] = code
+
+class _KNPStructure(object):
+    """
+    """
+
+    __metaclass__ = _KNPStructureType
+    __slots__ = ('nelements', '_buf', '_ref_size', '_lazy')
+    _attrs = []
+
+    def _knp_to_element(self, typ, key, els, pos):
         """
+        Convert the element(s) starting at els[pos] to a value of type
+        typ.  Return the value and the position of the next element.
         """
         is_struct = inspect.isclass(typ) and issubclass(typ, _KNPStructure)
         is_native = type(typ) is str
-        nb = 1
 
         if is_struct:
-            obj = typ(args)
-            return (obj, obj.nelements)
+            obj = typ()
+            return (obj, obj._from_elements(els, pos))
 
         elif is_native:
+            if pos >= len(els):
+                raise KNPFatalError("Malformed KNP packet")
+            el = els[pos]
             if typ == 'S':
                 if el.__class__ != KNPString:
                     s = "Incorrect type received for structure %s element %s"
                     s += " Expected String, got %s"
                     raise KNPClientFatalError(s % (self.__class__, key, el.name()))
                 else:
-                    return (el.val, nb)
+                    return (el.val, pos + 1)
             elif typ == 'I':
                 if el.__class__ != KNPInteger:
                     s = "Incorrect type received for structure %s element %s."
                     s += " Expected type Integer, got %s"
                     raise KNPClientFatalError(s % (self.__class__, key, el.name()))
                 else:
-                    return (el.val, nb)
+                    return (el.val, pos + 1)
             elif typ == 'L':
                 if el.__class__ != KNPLongInteger:
                     s = "Incorrect type received for structure %s element %s"
                     s += " Expected type LongInteger, got %s"
                     raise KNPClientFatalError(s % (self.__class__, key, el.name()))
                 else:
-                    return (el.val, nb)
+                    return (el.val, pos + 1)
+
+    def _from_elements(self, els, pos):
+        """
+        Set the fields from the elements of the list els, starting at
+        position pos.  Return the position of the first element not
+        used.
+        """
+        start = pos
+        for (key, typ, nb_attr, sub) in knp_codec(self.__class__).fields:
+            # Check for arrays.
+            if nb_attr != None:
+                # Handle arrays.  Each item starts where the previous
+                # one ended.
+                nb = getattr(self, nb_attr)
+                if nb:
+                    items = self._knp_new_array(typ)
+                    for i in range(0, nb):
+                        (el, pos) = self._knp_to_element(typ, key, els, pos)
+                        items.append(el)
+                    setattr(self, key, items)
+
+            # Structure or ordinary types.
+            else:
+                (el, pos) = self._knp_to_element(typ, key, els, pos)
+                setattr(self, key, el)
+
+        self.nelements = pos - start
+        return pos
+
+    def _knp_locate(self, typ, key, buf, pos, end, sub = None):
+        """
+        Read the element at offset pos of buf as a value of type typ,
+        without copying strings: their value is their (offset, size)
+        in buf.  Return the value and the offset of the next element.
+        sub is the codec of typ if it is a structure.
+        """
+        if sub != None:
+            obj = typ()
+            return (obj, obj._from_buffer(buf, pos, end, self._ref_size, self._lazy != None, sub))
+
+        if pos >= end:
+            raise KNPFatalError("Malformed KNP packet")
+        (el_typ,) = _knp_type_struct.unpack_from(buf, pos)
+        if not el_typ in _knp_element_classes:
+            raise KNPFatalError("Unknown KNP element type %d" % el_typ)
+        expected = _knp_native_types[typ]
+        if el_typ != expected:
+            s = "Incorrect type received for structure %s element %s."
+            s += " Expected type %s, got %s"
+            raise KNPClientFatalError(s % (self.__class__, key,
+                                           _knp_element_classes[expected](None).name(),
+                                           _knp_element_classes[el_typ](None).name()))
+
+        if el_typ == KNP_STR:
+            if end - pos < _knp_str_struct.size:
+                raise KNPFatalError("Malformed KNP packet")
+            (_, str_sz) = _knp_str_struct.unpack_from(buf, pos)
+            pos += _knp_str_struct.size
+            if end - pos < str_sz:
+                raise KNPFatalError("Malformed KNP packet")
+            return ((pos, str_sz), pos + str_sz)
+        else:
+            (uint_struct, uint_class) = _knp_uint_structs[el_typ]
+            if end - pos < uint_struct.size:
+                raise KNPFatalError("Malformed KNP packet")
+            return (int(uint_struct.unpack_from(buf, pos)[1]), pos + uint_struct.size)
+
+    def _knp_locate_strings(self, key, buf, pos, end, nb):
+        """
+        Locate the nb strings of an array starting at offset pos.
+        Return the list of their (offset, size) and the offset
+        following the array.
+        """
+        locs = []
+        unpack_from = _knp_str_struct.unpack_from
+        hdr_sz = _knp_str_struct.size
+        for i in xrange(0, nb):
+            if end - pos < hdr_sz or ord(buf[pos]) != KNP_STR:
+                # Let _knp_locate report what is wrong.
+                self._knp_locate('S', key, buf, pos, end)
+            (_, str_sz) = unpack_from(buf, pos)
+            pos += hdr_sz
+            if end - pos < str_sz:
+                raise KNPFatalError("Malformed KNP packet")
+            locs.append((pos, str_sz))
+            pos += str_sz
+        return (locs, pos)
+
+    def _knp_read_uints(self, typ, key, buf, pos, end, nb, items):
+        """
+        Read the nb integers of type typ of an array starting at
+        offset pos and append them to items.  They have a fixed size,
+        so they are unpacked by runs of up to _knp_run_size at a time.
+        Return the offset following the array.
+        """
+        el_typ = _knp_native_types[typ]
+        while nb > 0:
+            n = min(nb, _knp_run_size)
+            run = _knp_run_struct(el_typ, n)
+            if end - pos < run.size:
+                raise KNPFatalError("Malformed KNP packet")
+            vals = run.unpack_from(buf, pos)
+            if vals[0::2].count(el_typ) != n:
+                # Let _knp_locate report the offending element.
+                for i in xrange(0, n):
+                    (el, pos) = self._knp_locate(typ, key, buf, pos, end)
+            items.extend(vals[1::2])
+            pos += run.size
+            nb -= n
+        return pos
+
+    def _from_buffer(self, buf, pos, end, ref_size = None, lazy = False, codec = None):
+        """
+        Set the fields from the body in buf, starting at offset pos,
+        following the fields of codec, which defaults to the one with
+        all the fields.  Return the offset following the structure.
+
+        If lazy is true, strings are not copied.  Their offsets are
+        recorded and they are read from buf when first accessed, see
+        __getattr__.  Arrays of strings are then KNPLazyArray objects.
+        """
+        if lazy:
+            self._buf = buf
+            self._lazy = {}
+        self._ref_size = ref_size
+        if codec == None: codec = knp_codec(self.__class__)
+        for (key, typ, nb_attr, sub) in codec.fields:
+            if nb_attr != None:
+                nb = getattr(self, nb_attr)
+                if not nb: continue
+                if typ == 'S':
+                    (locs, pos) = self._knp_locate_strings(key, buf, pos, end, nb)
+                    if lazy:
+                        items = KNPLazyArray(buf, locs)
+                    else:
+                        items = [_knp_string_at(buf, p, sz, ref_size) for (p, sz) in locs]
+                elif typ in _knp_native_types:
+                    items = self._knp_new_array(typ)
+                    pos = self._knp_read_uints(typ, key, buf, pos, end, nb, items)
+                else:
+                    items = []
+                    for i in xrange(0, nb):
+                        (el, pos) = self._knp_locate(typ, key, buf, pos, end, sub)
+                        items.append(el)
+                setattr(self, key, items)
+
+            elif typ == 'S':
+                ((p, sz), pos) = self._knp_locate(typ, key, buf, pos, end)
+                if lazy:
+                    self._lazy[key] = (p, sz)
+                    delattr(self, key)
+                else:
+                    setattr(self, key, _knp_string_at(buf, p, sz, ref_size))
+
+            else:
+                (el, pos) = self._knp_locate(typ, key, buf, pos, end, sub)
+                setattr(self, key, el)
+        return pos
+
+    def __getattr__(self, key):
+        # Only called for attributes not found otherwise, such as the
+        # strings of lazily decoded structures not yet read, whose
+        # slots are empty.
+        if key == '_lazy': raise AttributeError(key)
+        lazy = self._lazy
+        if not lazy or not key in lazy:
+            raise AttributeError(key)
+        (pos, sz) = lazy.pop(key)
+        val = _knp_string_at(self._buf, pos, sz, self._ref_size)
+        setattr(self, key, val)
+        return val
+
+    def field_size(self, key):
+        """
+        Return the length of the string field key.  A string not yet
+        read from a lazily decoded body isn't read.
+        """
+        if self._lazy and key in self._lazy:
+            try:
+                object.__getattribute__(self, key)
+            except AttributeError:
+                return self._lazy[key][1]
+        val = getattr(self, key)
+        if val == None: return 0
+        return len(val)
+
+    def _knp_new_array(self, typ):
+        """
+        Return an empty array for items of type typ.  Integers are
+        kept in an array object when possible.
+        """
+        if typ in _knp_array_codes:
+            return array(_knp_array_codes[typ])
+        return []
+
+    def __getstate__(self):
+        # Lazy strings are read and references copied, the body isn't
+        # pickled.  It may be a mmap, which can't be.
+        return dict([(v[0], _knp_plain(getattr(self, v[0]))) for v in self.__class__._attrs])
+
+    def __setstate__(self, state):
+        self.__init__()
+        for (key, val) in state.items():
+            setattr(self, key, val)
 
     def __init__(self, *args):
         self.nelements = 0
+        self._buf = None
+        self._ref_size = None
+        self._lazy = None
 
         for v in self.__class__._attrs:
             (key, typ, ver) = v
             if inspect.isclass(typ) and issubclass(typ, _KNPStructure):
-                self.__dict__[key] = typ()
+                setattr(self, key, typ())
             elif type(typ) is tuple:
-                self.__dict__[key] = []
+                setattr(self, key, [])
             elif type(typ) is str:
-                self.__dict__[key] = None
+                setattr(self, key, None)
             else:
                 raise KNPClientFatalError("Incorrect structure definition")
 
         if args:
-            args = list(*args)
-
-            for v in self.__class__._attrs:
-                (key, typ, ver) = v
-                el = args[0]
-
-                is_array = type(typ) is tuple
-                is_struct = inspect.isclass(typ) and issubclass(typ, _KNPStructure)
-                is_native = type(typ) is str
-                nb = 0
-
-                # Check for arrays.
-                if is_array:
-                    (nb_attr, typ) = typ
-
-                    # Handle arrays.
-                    if nb_attr in self.__dict__ and self.__dict__[nb_attr]:
-                        self.__dict__[key] = []
-                        for i in range(0, self.__dict__[nb_attr]):
-                            (el, n) = self._knp_to_element(typ, key, el, args)
-                            self.__dict__[key].append(el)
-                            nb += n
-
-                # Check for structure or ordinary types.
-                elif is_struct or is_native:
-                    (el, n) = self._knp_to_element(typ, key, el, args)
-                    self.__dict__[key] = el
-                    nb += n
-
-                self.nelements += nb
-                for i in range(0, nb): del args[0]
+            self._from_elements(args[0], 0)
 
     def __str__(self):
         sl = []
         for v in self.__class__._attrs:
             (key, typ, ver) = v
-            if key in self.__dict__:
-                sl.append("%s: %s" % (key, str(self.__dict__[key])))
+            if hasattr(self, key):
+                sl.append("%s: %s" % (key, str(getattr(self, key))))
             else:
                 if typ == "S":
                     sl.append("%s: %s" % (key, "\"\""))
@@ -117,65 +321,128 @@ class _KNPStructure:
                     sl.append("%s: %s" % (key, "0"))
         return " ".join(sl)
 
-    def _elements_to_knp(self, typ, el):
-        s = ""
-        # Substructure types.
-        if inspect.isclass(typ) and issubclass(typ, _KNPStructure):
-            struct_typ = typ._attrs
-            s += el.to_knp()
-
-        # Simple types.
-        elif type(typ) is str:
-            if typ == 'S':
-                if el:
-                    s += KNPString(el).to_knp()
-                else:
-                    s += KNPString("").to_knp()
-            elif typ == 'I':
-                if el:
-                    s += KNPInteger(int(el)).to_knp()
-                else:
-                    s += KNPInteger(0).to_knp()
-            elif typ == 'L':
-                if el:
-                    s += KNPLongInteger(int(el)).to_knp()
-                else:
-                    s += KNPLongInteger(0).to_knp()
-        return s
-
-    def to_knp(self):
+    def to_knp(self, version = None):
         """
         Convert the KNP structure into a KNP request suitable to be
-        sent over the wire.
+        sent over the wire.  Only the fields that exist in the given
+        protocol version are included, all of them by default.
         """
-        s = ""
-        for v in self.__class__._attrs:
-            (key, typ, ver) = v
+        return knp_codec(self.__class__, version).encode(self)
 
-            is_array = type(typ) is tuple
-            is_struct = inspect.isclass(typ) and issubclass(typ, _KNPStructure)
-            is_native = type(typ) is str
+    def __len__(self):
+        # FIXME: Not sure this is efficient.
+        return len(self.to_knp())
 
-            # Check for arrays.
-            if is_array:
-                (nb_attr, typ) = typ
+def _knp_parse_version(version):
+    """
+    Return the (major, minor) tuple of a version string such as "4.1".
+    """
+    try:
+        (major, minor) = version.split(".")
+        return (int(major), int(minor))
+    except (ValueError, AttributeError):
+        raise KNPClientFatalError("Invalid protocol version: %r" % (version,))
 
-                # Handle arrays as a set of native type.
-                if nb_attr in self.__dict__ and self.__dict__[nb_attr]:
-                    self.__dict__[nb_attr] = len(self.__dict__[key])
-                    for i in range(0, self.__dict__[nb_attr]):
-                        s += self._elements_to_knp(typ, self.__dict__[key][i])
+class KNPCodec(object):
+    """
+    Encoder and decoder of a structure class for a protocol version.
+    Fields introduced by later versions are left out.  If version is
+    None, all the fields are kept.
 
-            # Handle structures and simple types
-            elif is_struct or is_native:
-                s += self._elements_to_knp(typ, self.__dict__[key])
-            else:
+    The structure definition is interpreted once, here.  Use
+    knp_codec() to get the codec of a structure, which is only built
+    the first time.
+    """
+
+    __slots__ = ('st_class', 'version', 'fields')
+
+    def __init__(self, st_class, version = None):
+        self.st_class = st_class
+        self.version = version
+        max_ver = None
+        if version != None:
+            max_ver = _knp_parse_version(version)
+
+        # (key, item type, count field or None, codec of the item type
+        # if it is a structure)
+        self.fields = []
+        for (key, typ, ver) in st_class._attrs:
+            if max_ver != None and _knp_parse_version(ver) > max_ver:
+                continue
+            nb_attr = None
+            if type(typ) is tuple:
+                (nb_attr, typ) = typ
+            sub = None
+            if inspect.isclass(typ) and issubclass(typ, _KNPStructure):
+                sub = knp_codec(typ, version)
+            elif not typ in ('S', 'I', 'L'):
                 raise KNPClientFatalError("Incorrect structure definition.")
-        return s
+            self.fields.append((key, typ, nb_attr, sub))
+
+    def _encode_value(self, typ, sub, el):
+        if sub != None:
+            return sub.encode(el)
+        elif typ == 'S':
+            if el:
+                return KNPString(el).to_knp()
+            return KNPString("").to_knp()
+        elif typ == 'I':
+            if el:
+                return KNPInteger(int(el)).to_knp()
+            return KNPInteger(0).to_knp()
+        else:
+            if el:
+                return KNPLongInteger(int(el)).to_knp()
+            return KNPLongInteger(0).to_knp()
+
+    def encode(self, st):
+        """
+        Return the body for the structure st.
+        """
+        parts = []
+        for (key, typ, nb_attr, sub) in self.fields:
+            if nb_attr != None:
+                # Arrays are sent only if their count is set.
+                if getattr(st, nb_attr):
+                    items = getattr(st, key)
+                    setattr(st, nb_attr, len(items))
+                    for el in items:
+                        parts.append(self._encode_value(typ, sub, el))
+            else:
+                parts.append(self._encode_value(typ, sub, getattr(st, key)))
+        return "".join(parts)
 
-    def __len__(self):
-        # FIXME: Not sure this is efficient.
-        return len(self.to_knp())
+    def decode(self, buf, ref_size = None, lazy = False):
+        """
+        Decode the body held in buf.  See knp_decode.  The body must
+        hold nothing past the structure.
+        """
+        st = self.st_class()
+        if st._from_buffer(buf, 0, len(buf), ref_size, lazy, self) != len(buf):
+            raise KNPFatalError("Malformed KNP packet")
+        return st
+
+# (structure class, version) -> KNPCodec
+_knp_codecs = {}
+
+def knp_codec(st_class, version = None):
+    """
+    Return the codec of the structure class st_class for the protocol
+    version, a string such as "4.1".  All the fields are kept if
+    version is None.
+    """
+    codec = _knp_codecs.get((st_class, version))
+    if codec == None:
+        codec = KNPCodec(st_class, version)
+        _knp_codecs[(st_class, version)] = codec
+    return codec
+
+class _KNPSkipped(_KNPStructure):
+    _attrs = []
+    _num = 0 # Body read only to be dropped, see skip_structure.
+
+    def _from_buffer(self, buf, pos, end, *args):
+        return end
 
 class KNPPkgRecipient(_KNPStructure):
     _attrs = [('addr', 'S', '2.1'),
@@ -320,20 +587,25 @@ class KNPGetEncKeyByIdResponse(_KNPStructure):
               ('owner_name', 'S', '4.1')]
     _num = 0 # Response. Not to be sent on the wire.
 
-class _KNPElement:
+class _KNPElement(object):
+    __slots__ = ()
+
     def to_knp(self): pass
     def __len__(self): pass
 
 class KNPString(_KNPElement):
+    __slots__ = ('val',)
     format = "!II"
 
     def __init__(self, s):
         self.val = s
 
     def to_knp(self):
+        val = self.val
+        if isinstance(val, KNPStringRef): val = str(val)
         buf = ""
-        buf += struct.pack("!BI", KNP_STR, len(self.val))
-        buf += self.val
+        buf += struct.pack("!BI", KNP_STR, len(val))
+        buf += val
         return buf
 
     def __len__(self):
@@ -342,6 +614,7 @@ class KNPString(_KNPElement):
     def name(self): return "String"
 
 class KNPInteger(_KNPElement):
+    __slots__ = ('val',)
     format = "!BL"
 
     def __init__(self, n):
@@ -356,6 +629,7 @@ class KNPInteger(_KNPElement):
     def name(self): return "Integer"
 
 class KNPLongInteger(_KNPElement):
+    __slots__ = ('val',)
     format = "!BQ"
 
     def __init__(self, n):
@@ -369,7 +643,8 @@ class KNPLongInteger(_KNPElement):
 
     def name(self): return "Long Integer"
 
-class KNPHeader:
+class KNPHeader(object):
+    __slots__ = ('major', 'minor', 'typ', 'size')
     format = "!IIII"
 
     def __init__(self, major = None, minor = None, typ = None, size = None):
@@ -381,42 +656,204 @@ class KNPHeader:
     def to_knp(self):
         return struct.pack(KNPHeader.format, self.major, self.minor, self.typ, self.size)
 
-class KNPConnection:
-    def __read_string(self, buf):
+class KNPStringRef(object):
+    """
+    Value of a string element left in a spooled message body, see
+    KNPConnection.spool_size.  It is a region of the buffer, usually a
+    mmap of the temporary file holding the body, so it is only copied
+    in memory when str() is called.  It compares with strings and
+    other references.
+    """
+
+    __slots__ = ('buf', 'offset', 'size')
+    chunk_size = 65536
+
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    def chunks(self):
         """
+        Iterate over the content, chunk_size bytes at a time.
         """
-        # Skip the string type.
-        buf = buf[1:]
-        # Read the string size.
-        str_sz_fmt = "!I"
-        str_sz_sz = struct.calcsize(str_sz_fmt)
-        if len(buf) < str_sz_sz:
-            raise KNPFatalError("Malformed KNP packet")
-        str_sz_buf = buf[:str_sz_sz]
-        (str_sz,) = struct.unpack(str_sz_fmt, str_sz_buf)
-        buf = buf[str_sz_sz:]
+        end = self.offset + self.size
+        for pos in range(self.offset, end, self.chunk_size):
+            yield self.buf[pos:min(pos + self.chunk_size, end)]
 
-        # Read the string itself.
-        if len(buf) < str_sz:
-            raise KNPFatalError("Malformed KNP packet")
-        _str = buf[:str_sz]
-        buf = buf[str_sz:]
+    def write_to(self, f):
+        """
+        Write the content to the file object f.
+        """
+        for b in self.chunks():
+            f.write(b)
 
-        if not _str: _str = ""
+    def __str__(self):
+        return self.buf[self.offset:self.offset + self.size]
+
+    def __eq__(self, other):
+        if not isinstance(other, (str, KNPStringRef)): return NotImplemented
+        if len(other) != self.size: return False
+        pos = 0
+        for b in self.chunks():
+            if other[pos:pos + len(b)] != b: return False
+            pos += len(b)
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getitem__(self, i):
+        # Slices only, as needed to compare references together.
+        (start, stop, step) = i.indices(self.size)
+        return self.buf[self.offset + start:self.offset + max(start, stop)]
+
+class KNPLazyArray(object):
+    """
+    Array of strings of a lazily decoded structure.  It holds the
+    offset and size of each string in the body, and its items are
+    KNPStringRef objects over them.  Comparing an item with a string
+    of a different length, such as "", doesn't read the item.
+    """
+
+    __slots__ = ('buf', 'locs')
+
+    def __init__(self, buf, locs):
+        self.buf = buf
+        self.locs = locs
+
+    def __len__(self):
+        return len(self.locs)
 
-        return (buf, KNPString(_str))
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return KNPLazyArray(self.buf, self.locs[i])
+        (pos, sz) = self.locs[i]
+        return KNPStringRef(self.buf, pos, sz)
 
-    def __read_uint(self, buf, uint_class):
+    def __iter__(self):
+        for (pos, sz) in self.locs:
+            yield KNPStringRef(self.buf, pos, sz)
+
+    def sizes(self):
         """
+        Return the list of the lengths of the items.
         """
-        uint_fmt = uint_class.format
-        uint_sz = struct.calcsize(uint_fmt)
-        if len(buf) < uint_sz:
-            raise KNPFatalError("Malformed KNP packet")
-        uint_buf = buf[:uint_sz]
-        buf = buf[uint_sz:]
-        return (buf, uint_class(int(struct.unpack(uint_fmt, uint_buf)[1])))
+        return [sz for (pos, sz) in self.locs]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, KNPLazyArray)): return NotImplemented
+        if len(other) != len(self.locs): return False
+        for i in range(0, len(self.locs)):
+            if self[i] != other[i]: return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return str([str(r) for r in self])
+
+def _knp_plain(val):
+    """
+    Return val with its KNPStringRef objects replaced by strings,
+    including the items of lists and lazy arrays.
+    """
+    if isinstance(val, KNPStringRef):
+        return str(val)
+    if isinstance(val, (list, KNPLazyArray)):
+        return [_knp_plain(v) for v in val]
+    return val
+
+_knp_type_struct = struct.Struct("!B")
+_knp_str_struct = struct.Struct("!BI")
+_knp_uint_structs = {KNP_UINT32: (struct.Struct(KNPInteger.format), KNPInteger),
+                     KNP_UINT64: (struct.Struct(KNPLongInteger.format), KNPLongInteger)}
+_knp_element_classes = {KNP_STR: KNPString,
+                        KNP_UINT32: KNPInteger,
+                        KNP_UINT64: KNPLongInteger}
+_knp_native_types = {'S': KNP_STR, 'I': KNP_UINT32, 'L': KNP_UINT64}
+
+# Integer arrays are unpacked by runs of up to _knp_run_size elements
+# with a single Struct.  (element type, run length) -> Struct
+_knp_run_size = 256
+_knp_run_structs = {}
+
+def _knp_run_struct(el_typ, n):
+    run = _knp_run_structs.get((el_typ, n))
+    if run == None:
+        fmt = _knp_uint_structs[el_typ][0].format[1:]
+        run = struct.Struct("!" + fmt * n)
+        _knp_run_structs[(el_typ, n)] = run
+    return run
+
+def _knp_string_at(buf, pos, sz, ref_size):
+    """
+    Return the string of sz bytes at offset pos of buf, or a
+    KNPStringRef to it if it is longer than ref_size.
+    """
+    if ref_size != None and sz > ref_size:
+        return KNPStringRef(buf, pos, sz)
+    return buf[pos:pos + sz]
+
+def knp_read_elements(buf, ref_size = None):
+    """
+    Parse the KNP elements of a message body.  Return a list of
+    KNPString, KNPInteger and KNPLongInteger objects.
+
+    buf can be a string or a mmap.  It is read in place, by offset.
+    Strings longer than ref_size, if given, are returned as
+    KNPStringRef objects pointing into buf.
+    """
+    els = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        # Read the element type.
+        (typ,) = _knp_type_struct.unpack_from(buf, pos)
+
+        # Read the element itself.
+        if typ == KNP_STR:
+            if end - pos < _knp_str_struct.size:
+                raise KNPFatalError("Malformed KNP packet")
+            (_, str_sz) = _knp_str_struct.unpack_from(buf, pos)
+            pos += _knp_str_struct.size
+            if end - pos < str_sz:
+                raise KNPFatalError("Malformed KNP packet")
+            if ref_size != None and str_sz > ref_size:
+                els.append(KNPString(KNPStringRef(buf, pos, str_sz)))
+            else:
+                els.append(KNPString(buf[pos:pos + str_sz]))
+            pos += str_sz
+        elif typ in _knp_uint_structs:
+            (uint_struct, uint_class) = _knp_uint_structs[typ]
+            if end - pos < uint_struct.size:
+                raise KNPFatalError("Malformed KNP packet")
+            els.append(uint_class(int(uint_struct.unpack_from(buf, pos)[1])))
+            pos += uint_struct.size
+        else:
+            raise KNPFatalError("Unknown KNP element type %d" % typ)
+    return els
+
+def knp_decode(buf, st_class, ref_size = None, lazy = False, version = None):
+    """
+    Decode a message body held in memory as a structure of class
+    st_class, as sent in the given protocol version.  See
+    knp_read_elements for ref_size.
 
+    The body is decoded directly, following the structure
+    definition.  If lazy is true, strings are only read from buf when
+    accessed.  See _KNPStructure._from_buffer.
+    """
+    return knp_codec(st_class, version).decode(buf, ref_size, lazy)
+
+class KNPConnection:
     # NOTE: Unlike write_structure, read_header and read_structure are
     # separated because we can't decide before time what structure we
     # need to read from the wire, if any, before receiving the header.
@@ -431,79 +868,140 @@ class KNPConnection:
         header_sz = struct.calcsize(header_fmt)
         buf = self.__read(header_sz)
         (major, minor, typ, sz) = struct.unpack(header_fmt, buf)
-        return KNPHeader(major, minor, typ, sz)
 
-    def __read_elements(self, buf):
-        els = []
-        while len(buf) > 0:
-            # Read the element type.
-            typ_fmt = "!B"
-            typ_sz = struct.calcsize(typ_fmt)
-            if len(buf) < typ_sz:
-                raise KNPFatalError("Malformed KNP packet")
-            typ_buf = buf[:typ_sz]
-            (typ,) = struct.unpack(typ_fmt, typ_buf)
+        # The time to first byte belongs to the request, the rest to
+        # the response.
+        if self.__first_byte_at != None:
+            req = KNPTypeStats()
+            req.first_byte_time = self.__first_byte_at - self.__sent_at
+            self.stats.account(self.__sent_typ, req)
+            self.__first_byte_at = None
+        self.__io.count = 1
+        self.stats.account(typ, self.__io)
+        self.__io = KNPTypeStats()
+        self.__recv_typ = typ
+
+        self.check_frame_size(typ, sz)
+        return KNPHeader(major, minor, typ, sz)
 
-            el = None
+    def frame_limit(self, typ):
+        """
+        Return the largest body accepted for messages of type typ.
+        """
+        return self.frame_limits.get(typ, self.max_frame_size)
 
-            # Read the element itself.
-            if typ == KNP_STR:
-                (buf, el) = self.__read_string(buf)
-            elif typ == KNP_UINT32:
-                (buf, el) = self.__read_uint(buf, KNPInteger)
-            elif typ == KNP_UINT64:
-                (buf, el) = self.__read_uint(buf, KNPLongInteger)
+    def check_frame_size(self, typ, sz):
+        """
+        Raise KNPFatalError if a body of sz bytes is too large for a
+        message of type typ.  The connection can't be used afterward
+        since the body is left unread.
+        """
+        limit = self.frame_limit(typ)
+        if sz > limit:
+            s = "Body of %d bytes for message type %s exceeds the limit of %d bytes"
+            raise KNPFatalError(s % (sz, typ, limit))
 
-            els.append(el)
-        return els
+    def read_structure(self, sz, st_class, lazy = False):
+        """
+        Read a structure from the wire.  If lazy is true, its strings
+        are only copied out of the body when accessed, see knp_decode.
 
-    def read_structure(self, sz, st_class):
+        Bodies larger than spool_size are written to a temporary file
+        as they arrive and decoded from a mmap of it.  Their strings
+        larger than ref_size are KNPStringRef objects instead of
+        strings.
         """
-        Read a structure from the wire.
+        self.check_frame_size(self.__recv_typ, sz)
+        ref_size = None
+        if sz > self.spool_size:
+            f = tempfile.TemporaryFile()
+            try:
+                self.__read(sz, f)
+                f.flush()
+                buf = mmap.mmap(f.fileno(), sz, access = mmap.ACCESS_READ)
+            finally:
+                f.close()
+            ref_size = self.ref_size
+        else:
+            buf = self.__read(sz)
+        t = monotonic()
+        st = self.codec(st_class).decode(buf, ref_size, lazy)
+        self.__io.decode_time = monotonic() - t
+        self.stats.account(self.__recv_typ, self.__io)
+        self.__io = KNPTypeStats()
+        return st
+
+    def skip_structure(self, sz):
+        """
+        Read a body of sz bytes without decoding anything from it.
         """
-        buf = self.__read(sz)
-        els = self.__read_elements(buf)
-        return st_class(els)
+        self.read_structure(sz, _KNPSkipped, True)
 
-    def write_structure(self, el_obj):
+    def write_structure(self, el_obj, typ = None):
         """
         Write a structure _and_ it's accompanying header on the wire,
         the header before the wire.
+
+        'typ' overrides the message type of the structure.  This is
+        how a server sends responses, which have no type of their own.
+        If el_obj is None, only the header is sent.
         """
-        if el_obj._num == 0:
+        if typ == None:
+            typ = el_obj._num
+        if typ == 0:
             s = "Structure %s cannot be sent on the wire" % str(el_obj.__class__)
             raise KNPClientFatalError(s)
 
-        (major, minor) = self.version.split(".")
-        hdr_buf = KNPHeader(int(major), int(minor), el_obj._num, len(el_obj)).to_knp()
-        el_buf = el_obj.to_knp()
+        t = monotonic()
+        el_buf = ""
+        if el_obj != None:
+            el_buf = self.codec(el_obj.__class__).encode(el_obj)
+        hdr_buf = KNPHeader(self.major, self.minor, typ, len(el_buf)).to_knp()
+        self.__io.encode_time = monotonic() - t
+
         self.__write(hdr_buf + el_buf)
+        self.__io.count = 1
+        self.stats.account(typ, self.__io)
+        self.__io = KNPTypeStats()
+
+        # Wait for the first byte of the reply.
+        self.__sent_typ = typ
+        self.__sent_at = monotonic()
+        self.__first_byte_at = None
+        self.__waiting = True
 
-    def __read(self, sz):
+    def __read(self, sz, f = None):
         """
-        Low level read with timeout.
+        Low level read with timeout.  If f is given, what is read is
+        written to that file instead of being returned.
         """
-        buf = ""
+        bufs = []
         n = sz
         while n > 0:
-            (rd, _, er) = select.select([self.__knp_sock.fileno()],
+            (rd, _, er) = select.select([self.transport.fileno()],
                                         [],
-                                        [self.__knp_sock.fileno()],
+                                        [self.transport.fileno()],
                                         self.timeout / 1000)
-            try:
-                if len(rd) > 0:
-                    b = self.__ssl_session.recv(n)
-                    if len(b) > 0:
-                        buf += b
-                        n -= len(b)
-                    else:
-                        raise KNPException("Read error from server")
-                elif len(er) > 0:
-                    raise KNPException("Read error from server")
+            self.__io.wakeups += 1
+            if len(rd) > 0:
+                self.__io.recv_calls += 1
+                b = self.transport.recv(min(n, self.recv_size))
+                if b == None: continue
+                if len(b) > 0:
+                    if self.__waiting:
+                        self.__first_byte_at = monotonic()
+                        self.__waiting = False
+                    self.__io.bytes_received += len(b)
+                    if f: f.write(b)
+                    else: bufs.append(b)
+                    n -= len(b)
                 else:
-                    raise KNPException("Timeout")
-            except OperationWouldBlock, ex: pass
-        return buf
+                    raise KNPException("Read error from server")
+            elif len(er) > 0:
+                raise KNPException("Read error from server")
+            else:
+                raise KNPException("Timeout")
+        return "".join(bufs)
 
     def __write(self, buf):
         """
@@ -511,58 +1009,119 @@ class KNPConnection:
         buffer was written successfully.
         """
         n = len(buf)
-        s = 0
+        pos = 0
         while n > 0:
             (_, wr, er) = select.select([],
-                                        [self.__knp_sock.fileno()],
-                                        [self.__knp_sock.fileno()],
+                                        [self.transport.fileno()],
+                                        [self.transport.fileno()],
                                         self.timeout / 1000)
-            try:
-                if len(wr) > 0:
-                    s = self.__ssl_session.send(buf[-n])
-                    n -= s
-                elif len(er) > 0:
-                    raise KNPException("Write error to server.")
-                else:
-                    raise KNPException("Timeout")
-            except OperationWouldBlock, ex: pass
+            self.__io.wakeups += 1
+            if len(wr) > 0:
+                self.__io.send_calls += 1
+                # Send at most recv_size bytes at a time rather than
+                # copying what remains of buf on every call.
+                s = self.transport.send(buf[pos:pos + min(n, self.recv_size)])
+                if s == None: continue
+                self.__io.bytes_sent += s
+                pos += s
+                n -= s
+            elif len(er) > 0:
+                raise KNPException("Write error to server.")
+            else:
+                raise KNPException("Timeout")
 
-    def close(self):
-        try:
-            self.sock.setblocking(True)
-            self.ssl_session.bye()
-            self.ssl_session.shutdown()
-            self.ssl_session.close()
-        except: pass
+    def codec(self, st_class):
+        """
+        Return the codec of the structure class st_class for the
+        protocol version of the connection.
+        """
+        codec = self.__codecs.get(st_class)
+        if codec == None:
+            codec = knp_codec(st_class, self.version)
+            self.__codecs[st_class] = codec
+        return codec
 
-    def connect(self):
+    def snapshot(self):
         """
-        Connect to the target server through SSL.
+        Return a copy of the connection statistics.  See KNPStats.
         """
-        self.__knp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__ssl_creds = X509Credentials()
-        # GNUTLS obviously defaults to TLS.  We use SSLv3.
-        self.__ssl_creds.session_params.protocols = (PROTO_SSL3,)
+        return self.stats.snapshot()
 
-        # Proper connection.
-        self.__knp_sock.connect((self.knp_host, self.knp_port))
+    def close(self):
+        if self.transport:
+            try:
+                self.transport.close()
+            except: pass
 
-        # FIXME: Announce the certificate we will use.
-        self.__ssl_session = ClientSession(self.__knp_sock, self.__ssl_creds)
-        self.__ssl_session.handshake()
+    def attach(self, sock, session = None):
+        """
+        Use an already connected socket or transport instead of
+        connecting.  This is meant for the server side of a
+        connection.  'session' is the TLS session established on the
+        socket, if any.
+        """
+        if isinstance(sock, Transport):
+            self.transport = sock
+        elif session:
+            self.transport = TLSTransport(sock = sock, session = session)
+        else:
+            self.transport = TCPTransport(sock = sock)
+        self.transport.setblocking(False)
+
+    def connect(self):
+        """
+        Connect to the target server.  Unless a transport was given
+        to the constructor, this goes through SSL.
+        """
+        if not self.transport:
+            self.transport = TLSTransport(self.knp_host, self.knp_port)
+        self.transport.connect()
+        self.stats.handshake_time = self.transport.handshake_time
 
         # Set the socket non-blocking.
-        self.__knp_sock.setblocking(False)
+        self.transport.setblocking(False)
+
+    def __init__(self, version, knp_host, knp_port, transport = None):
+        """
+        'transport' is the Transport to use instead of TLS over TCP to
+        knp_host:knp_port.  See Transport.py.
 
-    def __init__(self, version, knp_host, knp_port):
+        version is the protocol version spoken, such as "4.1".
+        Structures are sent and received with the fields that exist
+        in that version only.
+        """
         self.version = version
+        (self.major, self.minor) = _knp_parse_version(version)
+        self.__codecs = {}
         self.knp_host = knp_host
         self.knp_port = knp_port
         self.timeout = 2000
-
-        self.__knp_sock = None
-        self.__ssl_creds = None
-        self.__ssl_session = None
+        self.transport = transport
+
+        # Limits on the size of the message bodies received, in bytes,
+        # by message type.  Only the responses carrying whole mails
+        # can be large.  Bodies above spool_size are kept in temporary
+        # files, see read_structure.
+        self.max_frame_size = 16 << 20
+        self.frame_limits = {KNP_CMD_PACKAGE_MAIL: 1 << 30,
+                             KNP_RES_PACKAGE_MAIL: 1 << 30,
+                             KNP_RES_DEC_KEY_HALF: 1 << 30,
+                             KNP_RES_DEC_KEY_FULL: 1 << 30}
+        self.spool_size = 16 << 20
+        self.ref_size = 1 << 20
+
+        # Largest number of bytes passed to a single recv() or send().
+        self.recv_size = 1 << 20
+
+        # Statistics.  I/O counters are accumulated in __io until we
+        # know which message type they belong to.
+        self.stats = KNPStats()
+        self.__io = KNPTypeStats()
+        self.__sent_typ = None
+        self.__sent_at = None
+        self.__first_byte_at = None
+        self.__waiting = False
+        self.__recv_typ = None
 
 if __name__ == "__main__":
     knp = KNPConnection("4.1", "kps.teambox.co", 443)
@@ -0,0 +1,293 @@
+# Local stand-in for a KPS/KOS.
+#
+# This answers the most common KNP commands with canned responses
+# built from the same structure definitions as the client side.  It
+# is meant for benchmarking the client side repeatably, on a single
+# machine, without network access.  It does not attempt to validate
+# anything beyond the framing and structure of the requests.
+#
+# Latency and payload sizes are configurable through the attributes
+# of KNPMockServer.  TLS is used if a certificate and a key are given,
+# and gnutls is only needed then.  serve() handles a single transport,
+# such as one end of socketpair_transports(), without listening.
+
+import os, sys, socket, select, threading, time, getopt
+try:
+    from gnutls.connection import *
+    from gnutls.crypto import *
+    from gnutls.errors import *
+except ImportError:
+    class GNUTLSError(Exception): pass
+from Protocol import *
+from Protocol import _KNPStructure
+from Constants import *
+
+__all__ = ['KNPMockServer']
+
+class _KNPUnknownRequest(_KNPStructure):
+    _attrs = []
+    _num = 0 # Whatever we don't know how to answer.
+
+class KNPMockServer:
+    """
+    Mock KNP server.  Every client connection is served by its own
+    thread.
+
+    Attributes:
+    - latency: seconds to wait before sending each response.
+    - key_size: size of the keys returned.
+    - pkg_size: size of the packaged mail returned.
+    - otut_size: size of the tickets and OTUT strings returned.
+    - users: dictionary of user names to passwords.  If None, any
+      login succeeds.
+    - unknown_addrs: addresses for which no encryption key is found.
+    """
+
+    def __init__(self, host = "localhost", port = 0, cert_file = None, key_file = None, version = "4.1"):
+        self.host = host
+        self.port = port
+        self.version = version
+        self.cert_file = cert_file
+        self.key_file = key_file
+
+        self.latency = 0.0
+        self.key_size = 256
+        self.pkg_size = 4096
+        self.otut_size = 64
+        self.users = None
+        self.unknown_addrs = []
+
+        # Seconds a client can stay idle before being dropped.
+        self.idle_timeout = 60
+
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.__creds = None
+
+        # Command number -> (request class, handler)
+        self.handlers = {KNP_CMD_LOGIN_USER: (KNPLoginUserRequest, self.login_user),
+                         KNP_CMD_LOGIN_OTUT: (KNPLoginOTUTRequest, self.login_otut),
+                         KNP_CMD_GET_ENC_KEY: (KNPGetEncKeyRequest, self.get_enc_key),
+                         KNP_CMD_GET_ENC_KEY_BY_ID: (KNPGetEncKeyByIdRequest, self.get_enc_key_by_id),
+                         KNP_CMD_GET_SIGN_KEY: (KNPGetSignKeyRequest, self.get_sign_key),
+                         KNP_CMD_PACKAGE_MAIL: (KNPPackageMailRequest, self.package_mail),
+                         KNP_CMD_GET_OTUT_TICKET: (KNPGetOTUTTicketRequest, self.get_otut_ticket),
+                         KNP_CMD_GET_OTUT_STRING: (KNPGetOTUTStringRequest, self.get_otut_string),
+                         KNP_CMD_VALIDATE_OTUT: (KNPValidateOTUTRequest, self.validate_otut)}
+
+    def payload(self, sz, seed = "K"):
+        """
+        Return a string of sz bytes.  The content is meaningless.
+        """
+        return (seed * sz)[:sz]
+
+    def login_user(self, req):
+        if self.users != None:
+            if not req.user_name in self.users or self.users[req.user_name] != req.user_secret:
+                return (KNP_RES_FAIL, None)
+        res = KNPLoginOkResponse()
+        res.encrypted_pwd = self.payload(32, "P")
+        return (KNP_RES_LOGIN_OK, res)
+
+    def login_otut(self, req):
+        res = KNPLoginOkResponse()
+        res.encrypted_pwd = ""
+        return (KNP_RES_LOGIN_OK, res)
+
+    def get_enc_key(self, req):
+        res = KNPGetEncKeyResponse()
+        res.key_array = []
+        res.subscriber_array = []
+        for addr in req.address_array:
+            if addr in self.unknown_addrs:
+                res.key_array.append("")
+                res.subscriber_array.append("")
+            else:
+                res.key_array.append(self.payload(self.key_size))
+                res.subscriber_array.append(addr)
+        res.nb_key = len(res.key_array)
+        res.nb_subs = len(res.subscriber_array)
+        return (KNP_RES_GET_ENC_KEY, res)
+
+    def get_enc_key_by_id(self, req):
+        res = KNPGetEncKeyByIdResponse()
+        res.tm_key_data = self.payload(self.key_size, "T")
+        res.key_data = self.payload(self.key_size)
+        res.owner_name = "Mock owner %d" % req.key_id
+        return (KNP_RES_GET_ENC_KEY_BY_ID, res)
+
+    def get_sign_key(self, req):
+        res = KNPGetSignKeyResponse()
+        res.tm_key_data = self.payload(self.key_size, "T")
+        res.key_data = self.payload(self.key_size)
+        res.owner_name = "Mock owner %d" % req.key_id
+        return (KNP_RES_GET_SIGN_KEY, res)
+
+    def package_mail(self, req):
+        res = KNPPackageMailResponse()
+        res.pkg_output = self.payload(self.pkg_size)
+        res.ksn = self.payload(24, "N")
+        if req.pkg_type & KNP_PKG_TYPE_ENC:
+            res.sym_key = self.payload(self.key_size, "S")
+        else:
+            res.sym_key = ""
+        return (KNP_RES_PACKAGE_MAIL, res)
+
+    def get_otut_ticket(self, req):
+        res = KNPGetOTUTTicketResponse()
+        res.ticket = self.payload(self.otut_size, "O")
+        return (KNP_RES_GET_OTUT_TICKET, res)
+
+    def get_otut_string(self, req):
+        res = KNPGetOTUTStringResponse()
+        res.otut_array = []
+        for i in range(0, req.in_otut_count):
+            res.otut_array.append(self.payload(self.otut_size, "O"))
+        res.out_otut_count = len(res.otut_array)
+        return (KNP_RES_GET_OTUT_STRING, res)
+
+    def validate_otut(self, req):
+        res = KNPValidateOTUTResponse()
+        res.remaining_use_count = 1
+        return (KNP_RES_VALIDATE_OTUT, res)
+
+    def handle(self, knp):
+        """
+        Serve requests on a KNPConnection until the client goes away.
+        """
+        while self.running:
+            hdr = knp.read_header()
+            if hdr.typ in self.handlers:
+                (req_class, handler) = self.handlers[hdr.typ]
+                req = knp.read_structure(hdr.size, req_class)
+                (typ, res) = handler(req)
+            else:
+                # Skip whatever was sent.
+                knp.read_structure(hdr.size, _KNPUnknownRequest)
+                (typ, res) = (KNP_RES_FAIL, None)
+
+            if self.latency > 0:
+                time.sleep(self.latency)
+            knp.write_structure(res, typ)
+
+    def _serve_transport(self, transport):
+        try:
+            try:
+                transport.connect()
+                knp = KNPConnection(self.version, None, None)
+                knp.timeout = self.idle_timeout * 1000
+                knp.attach(transport)
+                self.handle(knp)
+            except (KNPException, KNPFatalError, socket.error, GNUTLSError):
+                # Client went away or misbehaved.
+                pass
+        finally:
+            transport.close()
+
+    def _serve_client(self, sock):
+        try:
+            if self.__creds:
+                session = ServerSession(sock, self.__creds)
+                session.handshake()
+                transport = TLSTransport(sock = sock, session = session)
+            else:
+                transport = TCPTransport(sock = sock)
+        except (socket.error, GNUTLSError):
+            sock.close()
+            return
+        self._serve_transport(transport)
+
+    def serve(self, transport):
+        """
+        Serve requests on an already connected transport, in a new
+        thread.  The server doesn't need to be started for this.
+        """
+        self.running = True
+        t = threading.Thread(target = self._serve_transport, args = (transport,))
+        t.setDaemon(True)
+        t.start()
+        return t
+
+    def _serve(self):
+        while self.running:
+            (rd, _, _) = select.select([self.sock], [], [], 0.5)
+            if not rd: continue
+            (sock, _) = self.sock.accept()
+            t = threading.Thread(target = self._serve_client, args = (sock,))
+            t.setDaemon(True)
+            t.start()
+
+    def start(self):
+        """
+        Start listening.  If 'port' was 0, the port chosen by the
+        system is stored in 'port'.
+        """
+        if self.cert_file and self.key_file:
+            cert = X509Certificate(open(self.cert_file).read())
+            key = X509PrivateKey(open(self.key_file).read())
+            self.__creds = X509Credentials(cert, key)
+            self.__creds.session_params.protocols = (PROTO_SSL3,)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(16)
+        (_, self.port) = self.sock.getsockname()
+
+        self.running = True
+        self.thread = threading.Thread(target = self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+def usage():
+    sys.stderr.write("Command line arguments for the mock KNP server:\n")
+    sys.stderr.write("Server.py [-h host] [-p port] [-c cert -k key] [-l latency] [-s pkg size] [-K key size]\n")
+    sys.stderr.write("\t-h <host>\tAddress to listen on\n")
+    sys.stderr.write("\t-p <port>\tPort to listen on\n")
+    sys.stderr.write("\t-c <cert>\tPEM certificate, enables TLS with -k\n")
+    sys.stderr.write("\t-k <key>\tPEM private key\n")
+    sys.stderr.write("\t-l <ms>\t\tLatency added to each response\n")
+    sys.stderr.write("\t-s <bytes>\tSize of the packaged mails\n")
+    sys.stderr.write("\t-K <bytes>\tSize of the keys\n")
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h:p:c:k:l:s:K:")
+    except getopt.GetoptError, err:
+        sys.stderr.write(str(err) + "\n")
+        usage()
+        sys.exit(1)
+
+    srv = KNPMockServer(port = 4443)
+    for o, a in opts:
+        if o == "-h":
+            srv.host = a
+        elif o == "-p":
+            srv.port = int(a)
+        elif o == "-c":
+            srv.cert_file = a
+        elif o == "-k":
+            srv.key_file = a
+        elif o == "-l":
+            srv.latency = float(a) / 1000
+        elif o == "-s":
+            srv.pkg_size = int(a)
+        elif o == "-K":
+            srv.key_size = int(a)
+
+    srv.start()
+    sys.stdout.write("Listening on %s:%d\n" % (srv.host, srv.port))
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.stop()
@@ -0,0 +1,98 @@
+# Wire-level statistics for KNP connections.
+#
+# Counters are kept for the connection as a whole and for each KNP
+# message type.  Requests are accounted to their command number
+# (_num), responses to the type found in their header.  The time to
+# first response byte is accounted to the request that was waited
+# for.
+
+import time
+
+__all__ = ['KNPTypeStats', 'KNPStats']
+
+class KNPTypeStats:
+    """
+    Counters for a connection or for one message type.  Times are in
+    seconds.
+    """
+
+    counters = ['count', 'bytes_sent', 'bytes_received', 'send_calls',
+                'recv_calls', 'wakeups', 'first_byte_time', 'encode_time',
+                'decode_time']
+
+    def __init__(self):
+        for c in KNPTypeStats.counters:
+            setattr(self, c, 0)
+
+    def merge(self, other):
+        for c in KNPTypeStats.counters:
+            setattr(self, c, getattr(self, c) + getattr(other, c))
+
+    def to_dict(self):
+        d = {}
+        for c in KNPTypeStats.counters:
+            d[c] = getattr(self, c)
+        return d
+
+class KNPStats:
+    """
+    Statistics of a KNPConnection.
+
+    If dump_every() was called, a snapshot is written to the given
+    file every 'interval' seconds, checked each time a message is
+    accounted.
+    """
+
+    def __init__(self):
+        self.handshake_time = 0.0
+        self.total = KNPTypeStats()
+        self.types = {}
+        self.dump_interval = None
+        self.dump_out = None
+        self.last_dump = time.time()
+
+    def account(self, typ, st):
+        """
+        Add the counters in 'st' to message type 'typ' and to the
+        connection totals.
+        """
+        if not typ in self.types:
+            self.types[typ] = KNPTypeStats()
+        self.types[typ].merge(st)
+        self.total.merge(st)
+        self.maybe_dump()
+
+    def snapshot(self):
+        """
+        Return a copy of the statistics as a dictionary.
+        """
+        types = {}
+        for (typ, st) in self.types.items():
+            types[typ] = st.to_dict()
+        return {'handshake_time': self.handshake_time,
+                'total': self.total.to_dict(),
+                'types': types}
+
+    def dump_every(self, interval, out):
+        self.dump_interval = interval
+        self.dump_out = out
+
+    def dump(self, out):
+        """
+        Write the statistics in a human readable way.
+        """
+        out.write("handshake %.4fs\n" % self.handshake_time)
+        rows = [("total", self.total)]
+        for typ in sorted(self.types.keys()):
+            rows.append(("0x%08x" % typ, self.types[typ]))
+        for (name, st) in rows:
+            d = st.to_dict()
+            out.write("%-10s %s\n" % (name, " ".join(["%s=%s" % (c, d[c]) for c in KNPTypeStats.counters])))
+        out.flush()
+
+    def maybe_dump(self):
+        if not self.dump_interval: return
+        now = time.time()
+        if now - self.last_dump >= self.dump_interval:
+            self.last_dump = now
+            self.dump(self.dump_out)
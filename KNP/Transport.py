@@ -0,0 +1,208 @@
+# Transports for KNP and K3P connections.
+#
+# A transport is a connected byte stream.  KNPConnection and
+# K3PConnection only need what is defined in the Transport class
+# below, so they can run over TLS, plain TCP, a Unix domain socket or
+# an in-memory socket pair.  Plain transports are meant for local
+# runs, against the mock server or a co-located KMOD, where TLS would
+# only measure itself.
+#
+# gnutls is only needed for TLSTransport.
+
+import socket, errno
+from ProfK.Clock import monotonic
+
+try:
+    from gnutls.connection import *
+    from gnutls.constants import *
+    from gnutls.errors import *
+    _have_gnutls = True
+except ImportError:
+    _have_gnutls = False
+
+__all__ = ['TransportError', 'Transport', 'SocketTransport', 'TCPTransport',
+           'UnixTransport', 'TLSTransport', 'socketpair_transports']
+
+class TransportError(Exception):
+    """
+    Thrown when a transport cannot be established.
+    """
+    pass
+
+class Transport:
+    """
+    Interface of the transports.  recv() and send() follow the socket
+    semantics except that they return None instead of raising when a
+    non-blocking transport isn't ready.
+    """
+
+    def connect(self): pass
+    def fileno(self): pass
+    def recv(self, n): pass
+    def send(self, buf): pass
+    def setblocking(self, flag): pass
+    def settimeout(self, timeout): pass
+    def close(self): pass
+
+    # Time spent negotiating the transport in connect(), in seconds.
+    handshake_time = 0.0
+
+    def sendall(self, buf):
+        n = 0
+        while n < len(buf):
+            s = self.send(buf[n:])
+            if s: n += s
+
+    def makefile(self, mode = "r+b", bufsize = -1):
+        """
+        Return a file object reading and writing the transport.  It
+        must be used in blocking mode.
+        """
+        return socket._fileobject(self, mode, bufsize)
+
+class SocketTransport(Transport):
+    """
+    Transport over an already connected socket.
+    """
+
+    def __init__(self, sock = None):
+        self.sock = sock
+        self.timeout = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, n):
+        try:
+            return self.sock.recv(n)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return None
+            raise
+
+    def send(self, buf):
+        try:
+            return self.sock.send(buf)
+        except socket.error, ex:
+            if ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return None
+            raise
+
+    def sendall(self, buf):
+        self.sock.sendall(buf)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def settimeout(self, timeout):
+        """
+        Set the socket timeout, in seconds.  If not connected yet,
+        this also applies to connect().
+        """
+        self.timeout = timeout
+        if self.sock: self.sock.settimeout(timeout)
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error: pass
+
+    def close(self):
+        if self.sock:
+            self.shutdown()
+            self.sock.close()
+            self.sock = None
+
+class TCPTransport(SocketTransport):
+    """
+    Plain TCP transport.  Nagle's algorithm is disabled: both
+    protocols write a request and wait for its reply, so delaying the
+    last segment of a request only adds latency.
+    """
+
+    def __init__(self, host = None, port = None, sock = None):
+        SocketTransport.__init__(self, sock)
+        self.host = host
+        self.port = port
+        if sock: self.set_nodelay()
+
+    def set_nodelay(self):
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connect(self):
+        if self.sock: return
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.set_nodelay()
+
+class UnixTransport(SocketTransport):
+    """
+    Unix domain socket transport, for peers on the same host.
+    """
+
+    def __init__(self, path = None, sock = None):
+        SocketTransport.__init__(self, sock)
+        self.path = path
+
+    def connect(self):
+        if self.sock: return
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class TLSTransport(TCPTransport):
+    """
+    TLS over TCP, through gnutls.  This is what KPS and KOS expect.
+
+    On the server side, pass the accepted socket and the
+    ServerSession established on it.
+    """
+
+    def __init__(self, host = None, port = None, creds = None, sock = None, session = None):
+        if not _have_gnutls:
+            raise TransportError("gnutls is required for TLS transports.")
+        TCPTransport.__init__(self, host, port, sock)
+        self.creds = creds
+        self.session = session
+
+    def connect(self):
+        if self.session: return
+        if not self.creds:
+            self.creds = X509Credentials()
+            # GNUTLS obviously defaults to TLS.  We use SSLv3.
+            self.creds.session_params.protocols = (PROTO_SSL3,)
+        TCPTransport.connect(self)
+
+        # FIXME: Announce the certificate we will use.
+        t = monotonic()
+        self.session = ClientSession(self.sock, self.creds)
+        self.session.handshake()
+        self.handshake_time = monotonic() - t
+
+    def recv(self, n):
+        try:
+            return self.session.recv(n)
+        except OperationWouldBlock:
+            return None
+
+    def send(self, buf):
+        try:
+            return self.session.send(buf)
+        except OperationWouldBlock:
+            return None
+
+    def sendall(self, buf):
+        Transport.sendall(self, buf)
+
+    def close(self):
+        if self.session:
+            try:
+                self.sock.setblocking(True)
+                self.session.bye()
+            except (GNUTLSError, socket.error): pass
+            self.session = None
+        TCPTransport.close(self)
+
+def socketpair_transports():
+    """
+    Return two connected in-memory transports.
+    """
+    (a, b) = socket.socketpair()
+    return (SocketTransport(a), SocketTransport(b))
@@ -1,6 +1,7 @@
 import sys, time, unittest
 from unittest import *
 from datetime import *
+from Clock import monotonic
 
 class CheckerResult:
     """
@@ -15,6 +16,9 @@ class CheckerResult:
         self.desc = None
         self.start_time = 0
         self.end_time = 0
+        self.test_id = None
+        self.clock_start = 0
+        self.elapsed = 0.0
 
 class Checker(TestResult):
     def __init__(self):
@@ -67,12 +71,15 @@ class Checker(TestResult):
             self.tests[test].desc = test.__doc__.strip()
         else:
             self.tests[test].desc = test.__class__
+        self.tests[test].test_id = test.id()
         self.tests[test].start_time = datetime.today()
+        self.tests[test].clock_start = monotonic()
 
     def stopTest(self, test):
         """
         Called at the time the test is stopped.
         """
+        self.tests[test].elapsed = monotonic() - self.tests[test].clock_start
         self.tests[test].end_time = datetime.today()
 
     def run(self, test):
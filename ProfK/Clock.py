@@ -0,0 +1,37 @@
+# Monotonic clock for test timings.  Python doesn't provide one so we
+# call clock_gettime() directly, falling back to the wall clock if we
+# can't.
+
+import time, ctypes, ctypes.util
+
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+def _find_clock_gettime():
+    for lib in [ctypes.util.find_library("rt"), ctypes.util.find_library("c")]:
+        if not lib: continue
+        try:
+            f = ctypes.CDLL(lib).clock_gettime
+            f.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+            f.restype = ctypes.c_int
+            return f
+        except (OSError, AttributeError):
+            pass
+    return None
+
+_clock_gettime = _find_clock_gettime()
+
+def monotonic():
+    """
+    Return the value, in seconds, of a clock that cannot go
+    backward.  Only the difference between two values is meaningful.
+    """
+    if not _clock_gettime:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError("clock_gettime failed")
+    return ts.tv_sec + ts.tv_nsec / 1000000000.0
@@ -0,0 +1,64 @@
+# Storage of test timings across runs.
+#
+# Each test keeps its last timings in a dbm file, keyed by the test
+# identifier, as a packed array of doubles.  This is compact enough
+# for hourly runs to be kept for weeks.
+
+import anydbm
+from array import array
+
+def percentile(samples, p):
+    """
+    Return the p-th percentile (0-100) of a list of samples, that is
+    the sample whose index in sorted order is closest to
+    p / 100 * (n - 1).  Return None if there are no samples.
+    """
+    if not samples: return None
+    s = sorted(samples)
+    rank = int(round(p / 100.0 * (len(s) - 1)))
+    return s[rank]
+
+class TimingHistory:
+    """
+    Latency history of the tests, in seconds.
+    """
+
+    def __init__(self, path, max_samples = 500):
+        self.path = path
+        self.max_samples = max_samples
+        self.db = anydbm.open(path, "c")
+
+    def samples(self, test_id):
+        """
+        Return the array of timings stored for a test, oldest first.
+        """
+        a = array('d')
+        if self.db.has_key(test_id):
+            a.fromstring(self.db[test_id])
+        return a
+
+    def add(self, test_id, elapsed):
+        """
+        Append a timing to the history of a test, dropping the oldest
+        ones if there are more than max_samples.
+        """
+        a = self.samples(test_id)
+        a.append(elapsed)
+        if len(a) > self.max_samples:
+            a = a[len(a) - self.max_samples:]
+        self.db[test_id] = a.tostring()
+
+    def record(self, results):
+        """
+        Add the timings of successful tests from a list of
+        CheckerResult.  Failed tests are not recorded since their
+        timings are meaningless.
+        """
+        for r in results:
+            if r.ok:
+                self.add(r.test_id, r.elapsed)
+
+    def close(self):
+        if self.db != None:
+            self.db.close()
+            self.db = None
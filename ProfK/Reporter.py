@@ -1,4 +1,5 @@
 import Checker, traceback
+from History import percentile
 
 class TestReporter:
     """
@@ -121,4 +122,87 @@ class NegativeTestReporter(MostlyPositiveTestReporter):
                 run = True
                 break
         if run: MostlyPositiveTestReporter.report(self)
-    
+
+class TimingReporter(TestReporter):
+    """
+    Report the latency percentiles of the tests from a TimingHistory,
+    flag tests which are slower than their rolling baseline and list
+    the slowest tests of the run.
+
+    This has to be called before the results of the run are recorded
+    in the history, otherwise the run will be its own baseline.
+    """
+
+    def __init__(self, checker, history, out, slowest = 5, baseline = 20, tolerance = 0.5):
+        TestReporter.__init__(self, out)
+        self.checker = checker
+        self.history = history
+        self.slowest = slowest
+        self.baseline = baseline
+        self.tolerance = tolerance
+        self.nregress = 0
+
+    def is_regression(self, test_result, samples):
+        """
+        Return True if the test took more than 'tolerance' (0.5 for
+        50%) longer than the median of the last 'baseline' runs.
+        """
+        base = percentile(samples[-self.baseline:], 50)
+        if not base: return False
+        return test_result.elapsed > base * (1.0 + self.tolerance)
+
+    def summary(self, test_result):
+        if not test_result.ok: return
+
+        samples = self.history.samples(test_result.test_id)
+        regressed = self.is_regression(test_result, samples)
+        if regressed:
+            self.nregress += 1
+            base = samples[-self.baseline:]
+            base_tpl = (test_result.elapsed / percentile(base, 50) * 100.0 - 100.0, len(base))
+
+        samples.append(test_result.elapsed)
+        self.out.write("%s\n" % test_result.desc)
+        tpl = (test_result.elapsed,
+               percentile(samples, 50),
+               percentile(samples, 95),
+               percentile(samples, 99),
+               len(samples))
+        self.out.write("\t\t%.4fs (p50 %.4fs, p95 %.4fs, p99 %.4fs over %d runs)\n" % tpl)
+        if regressed:
+            self.out.write("\t\tREGRESSION: %.0f%% over the median of the last %d runs\n" % base_tpl)
+
+    def footer(self):
+        self.line()
+        results = [r for r in self.checker.results() if r.ok]
+        results.sort(key = lambda r: r.elapsed, reverse = True)
+        self.out.write("Slowest tests:\n")
+        for r in results[:self.slowest]:
+            self.out.write("%10.4fs  %s\n" % (r.elapsed, r.desc))
+        if self.nregress > 0:
+            self.out.write("%d test(s) regressed.\n" % self.nregress)
+
+class PhaseReporter(TestReporter):
+    """
+    Report where the time went in the plugin calls measured by a
+    K3P.K3PMetrics object: mean time per phase and bytes exchanged
+    per call.
+    """
+
+    def __init__(self, metrics, out):
+        TestReporter.__init__(self, out)
+        self.metrics = metrics
+
+    def summary(self, tot):
+        self.out.write("%s (%d calls)\n" % (tot.name, tot.count))
+        for p in self.metrics.phases:
+            if p in tot.timers:
+                self.out.write("\t\t%-8s %.4fs\n" % (p, tot.timers[p] / tot.count))
+        self.out.write("\t\ttotal    %.4fs, %d bytes out, %d bytes in\n" %
+                       (tot.elapsed / tot.count, tot.bytes_out / tot.count, tot.bytes_in / tot.count))
+
+    def report(self):
+        self.header()
+        for name in sorted(self.metrics.totals.keys()):
+            self.summary(self.metrics.totals[name])
+        self.footer()
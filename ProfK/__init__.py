@@ -1,2 +1,4 @@
 from Checker import Checker
-from Reporter import MostlyPositiveTestReporter, NegativeTestReporter
+from Reporter import MostlyPositiveTestReporter, NegativeTestReporter, TimingReporter, PhaseReporter
+from History import TimingHistory
+from Clock import monotonic
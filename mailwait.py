@@ -7,19 +7,41 @@
 # writable by the postfix process.
 #
 # This script will not throw errors out.  It will happily ignore write
-# errors.  It won't do anything if the socket doesn't exists.
+# errors.  If nobody listens on the socket, the mail is spooled in
+# /tmp/mailwait/ instead and clients can wait for it with inotify.
 
-import sys, os, os.path, stat, socket, select, syslog
+import sys, os, os.path, stat, grp, socket, syslog, tempfile, threading
+from StringIO import StringIO
 from datetime import datetime, timedelta
 from pyinotify import *
+from unixserver import *
 
 mailwait_dir = "/tmp/mailwait/"
+mailwait_sock = "/tmp/mailwait-sock"
 
-__all__ = ['mailwait', 'mailwait_receive']
+# Headers whose names start with one of those prefixes are kept in
+# the index as Teambox markers.
+mailwait_markers = ("x-teambox", "x-kryptiva")
+
+__all__ = ['mailwait', 'mailwait_receive', 'mailwait_indexed',
+           'MailIndex', 'MailIndexEntry', 'MailWaitListener']
 
 class MailWaitProcessor(ProcessEvent):
-    def process_IN_CREATE(self, event):
-        self.new_files.append(os.path.join(event.path, event.name))
+    # mailwait_receive() writes the mail under a hidden name then
+    # renames it, so a file is complete once it is moved in place.
+    # Files closed after writing are also taken in case they were
+    # written in place by something else.
+    def process_IN_MOVED_TO(self, event):
+        self.add(event)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.add(event)
+
+    def add(self, event):
+        if event.name.startswith("."): return
+        path = os.path.join(event.path, event.name)
+        if not path in self.new_files:
+            self.new_files.append(path)
 
     def __init__(self):
         self.new_files = []
@@ -35,13 +57,13 @@ def mailwait():
 
     # Check for files that are already there.  Return the list of
     # files if there are some files already.
-    files = os.listdir(mailwait_dir)
+    files = [f for f in os.listdir(mailwait_dir) if not f.startswith(".")]
     if len(files) > 0: return files
 
     # Otherwise, we have to wait for a new file.
     wm = WatchManager()
     wm_proc = MailWaitProcessor()
-    wm.add_watch(mailwait_dir, EventsCodes.IN_CREATE, rec = True)
+    wm.add_watch(mailwait_dir, EventsCodes.IN_MOVED_TO | EventsCodes.IN_CLOSE_WRITE, rec = True)
     n = Notifier(wm, wm_proc)
 
     # Wait for the event.
@@ -53,11 +75,306 @@ def mailwait():
 
     return wm_proc.new_files
 
+def mailwait_parse_headers(fobj):
+    """
+    Parse the RFC 822 header block of the mail in fobj, stopping at
+    the first blank line.  Return a tuple containing a dictionary of
+    the headers, keyed by lowercase header names, and the offset of
+    the first byte of the body.  Only the first occurence of a
+    header is kept.
+    """
+    headers = {}
+    offset = 0
+    name = None
+
+    while True:
+        line = fobj.readline()
+        if not line: break
+        offset += len(line)
+
+        line = line.rstrip("\r\n")
+        if not line: break
+
+        # Folded header line.
+        if line[0] in " \t":
+            if name: headers[name] += " " + line.strip()
+            continue
+
+        if not ":" in line:
+            name = None
+            continue
+
+        (name, value) = line.split(":", 1)
+        name = name.strip().lower()
+        if name in headers:
+            name = None
+        else:
+            headers[name] = value.strip()
+
+    return (headers, offset)
+
+class MailIndexEntry:
+    """
+    Compact summary of a spooled mail.  Only the header block of the
+    file is parsed.  The body stays on disk and is read back with a
+    single seek at body_offset.
+
+    Mails received through the mailwait socket have no path and are
+    kept in memory in 'data'.
+    """
+
+    def __init__(self, path = None, data = None):
+        if data != None:
+            fobj = StringIO(data)
+        else:
+            fobj = open(path, "rb")
+        try:
+            (headers, self.body_offset) = mailwait_parse_headers(fobj)
+            fobj.seek(0, os.SEEK_END)
+            self.size = fobj.tell()
+            self.mtime = None
+            if path != None: self.mtime = os.fstat(fobj.fileno()).st_mtime
+        finally:
+            fobj.close()
+
+        self.path = path
+        self.data = data
+        self.message_id = headers.get("message-id")
+        self.from_addr = headers.get("from")
+        self.to = headers.get("to")
+        self.subject = headers.get("subject")
+
+        self.markers = {}
+        for (k, v) in headers.items():
+            if k.startswith(mailwait_markers):
+                self.markers[k] = v
+
+    def matches(self, message_id = None, from_addr = None, to = None,
+                subject = None, marker = None):
+        """
+        Return True if the mail matches all the criterias given.
+        Addresses and subject are matched as case insensitive
+        substrings.  'marker' is the name of a Teambox header that
+        must be present.  This never reads the body.
+        """
+        def has(field, s):
+            return field != None and s.lower() in field.lower()
+
+        if message_id != None and self.message_id != message_id:
+            return False
+        if from_addr != None and not has(self.from_addr, from_addr):
+            return False
+        if to != None and not has(self.to, to):
+            return False
+        if subject != None and not has(self.subject, subject):
+            return False
+        if marker != None and not marker.lower() in self.markers:
+            return False
+        return True
+
+    def read_body(self):
+        """
+        Return the body of the mail.
+        """
+        if self.data != None:
+            return self.data[self.body_offset:]
+
+        fobj = open(self.path, "rb")
+        try:
+            fobj.seek(self.body_offset)
+            return fobj.read(self.size - self.body_offset)
+        finally:
+            fobj.close()
+
+    def __str__(self):
+        return "%s: %s -> %s (%s)" % (self.path, self.from_addr, self.to, self.subject)
+
+class MailIndex:
+    """
+    Index of the mail spooled in mailwait_dir.  A file is parsed again
+    only if its size or modification time changed.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def stale(self, path):
+        """
+        Return True if the file at 'path' isn't indexed or has changed
+        since it was.
+        """
+        entry = self.entries.get(path)
+        if entry == None: return True
+        st = os.stat(path)
+        return st.st_size != entry.size or st.st_mtime != entry.mtime
+
+    def add(self, path):
+        """
+        Index the file at 'path' if it isn't already, or again if it
+        changed, and return its entry.
+        """
+        if self.stale(path):
+            self.entries[path] = MailIndexEntry(path)
+        return self.entries[path]
+
+    def update(self, files):
+        """
+        Index a list of files, as returned by mailwait(), and forget
+        about files that have been removed.  Return the list of new
+        entries, including those of files that changed.
+        """
+        for path in self.entries.keys():
+            if not os.path.exists(path):
+                del self.entries[path]
+
+        new_entries = []
+        for f in files:
+            path = os.path.join(mailwait_dir, f)
+            if self.stale(path):
+                new_entries.append(self.add(path))
+        return new_entries
+
+    def match(self, **criterias):
+        """
+        Return the list of entries matching the criterias, as
+        understood by MailIndexEntry.matches.
+        """
+        r = []
+        for path in sorted(self.entries.keys()):
+            if self.entries[path].matches(**criterias):
+                r.append(self.entries[path])
+        return r
+
+    def consume(self, entry):
+        """
+        Unlink the file of an entry and remove it from the index.
+        """
+        if entry.path in self.entries:
+            del self.entries[entry.path]
+        os.unlink(entry.path)
+
+def mailwait_indexed(index):
+    """
+    Same as mailwait() but adds the files to 'index' and return the
+    list of new MailIndexEntry objects.
+    """
+    return index.update(mailwait())
+
+class MailWaitListener:
+    """
+    Listen on mailwait_sock for mail pushed by mailwait_receive() and
+    keep them in memory for the test clients.  The socket is served
+    by a background thread between start() and stop(), each mail
+    being received in a thread of its own.  While the listener runs,
+    mails are not written in mailwait_dir.  start() fails if another
+    listener is running.
+
+    Test scripts waiting for mail can get one with
+    testutils.mail_listener().
+
+    The receiver runs as the user postfix gives to it.  If 'group' is
+    given, the socket belongs to that group and only its members can
+    push mail.  Otherwise any local user can.
+    """
+
+    def __init__(self, path = None, group = None):
+        if not path:
+            self.path = mailwait_sock
+        else:
+            self.path = path
+        self.entries = []
+        self.cond = threading.Condition()
+        if group == None:
+            mode = stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
+            gid = None
+        else:
+            mode = stat.S_IRWXU | stat.S_IRWXG
+            gid = grp.getgrnam(group).gr_gid
+        self.server = UnixServer(self.path, self._receive, mode, gid)
+
+    def start(self):
+        """
+        Bind the socket and start accepting mails.
+        """
+        self.server.start()
+
+    def stop(self):
+        """
+        Stop accepting mails and remove the socket.  Mails already
+        received are kept.
+        """
+        self.server.stop()
+
+    def _receive(self, conn):
+        """
+        Read a whole mail from a client connection then acknowledge it.
+        """
+        conn.settimeout(5)
+        chunks = []
+        while True:
+            b = conn.recv(65536)
+            if not b: break
+            chunks.append(b)
+
+        # Nothing is sent by unix_socket_alive().
+        if not chunks: return
+
+        entry = MailIndexEntry(data = "".join(chunks))
+        self.cond.acquire()
+        try:
+            self.entries.append(entry)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        conn.sendall("OK")
+
+    def wait(self, timeout = None):
+        """
+        Wait for new mails.  Return the list of MailIndexEntry
+        received so far and forget about them.  Return an empty list
+        if nothing arrived within timeout seconds.
+        """
+        self.cond.acquire()
+        try:
+            if not self.entries:
+                self.cond.wait(timeout)
+            entries = self.entries
+            self.entries = []
+            return entries
+        finally:
+            self.cond.release()
+
+def mailwait_push(msg):
+    """
+    Hand a mail to a MailWaitListener through mailwait_sock.  Return
+    False if nobody is listening, in which case the mail has to be
+    spooled.
+    """
+    if not os.path.exists(mailwait_sock):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(5)
+            sock.connect(mailwait_sock)
+            sock.sendall(msg)
+            sock.shutdown(socket.SHUT_WR)
+
+            # The listener acknowledges the mail once it has all of
+            # it.
+            return sock.recv(2) == "OK"
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+
 def mailwait_receive():
     """
     This is to be called by postfix on reception of a new mail.  This
-    create a new file in /tmp/mailwait/ if a 'RUN' file exist in that
-    directory.
+    pushes the mail to the listener on /tmp/mailwait-sock if there is
+    one, otherwise this creates a new file in /tmp/mailwait/.
     """
     try:
         mailwait_index = 0
@@ -69,21 +386,33 @@ def mailwait_receive():
         # I think is reasonable.
         msg = sys.stdin.read()
 
-        # Add the received file in the directory.
-        while os.path.exists(os.path.join(mailwait_dir, "%04d" % mailwait_index)) and mailwait_index < 10000:
-            mailwait_index += 1
+        # Push the message to the listener if there is one.
+        if mailwait_push(msg):
+            syslog.syslog(syslog.LOG_DEBUG, "mailwait has delivered its package to %s" % mailwait_sock)
+            return
+
+        # Write the mail under a hidden name first.  Clients only see
+        # it once it is complete, when it is renamed.
+        (fd, tmp_name) = tempfile.mkstemp(prefix = ".", dir = mailwait_dir)
+        try:
+            fobj = os.fdopen(fd, "w")
+            fobj.write(msg)
+            fobj.close()
+
+            # Postfix runs this program as an unpriviledged user.
+            os.chmod(tmp_name, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
 
-        if mailwait_index > 9999:
-            raise Exception("/tmp/mailwait is full")
-            
-        file_name = os.path.join(mailwait_dir, "%04d" % mailwait_index)
+            while os.path.exists(os.path.join(mailwait_dir, "%04d" % mailwait_index)) and mailwait_index < 10000:
+                mailwait_index += 1
 
-        fobj = open(file_name, "w")
-        fobj.write(msg)
-        fobj.close()
+            if mailwait_index > 9999:
+                raise Exception("/tmp/mailwait is full")
 
-        # Postfix runs this program as an unpriviledged user.
-        os.chmod(file_name, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            file_name = os.path.join(mailwait_dir, "%04d" % mailwait_index)
+            os.rename(tmp_name, file_name)
+        except:
+            os.unlink(tmp_name)
+            raise
 
         # Scan the directory for old files.  Delete file older
         # than 5 minutes.
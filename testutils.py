@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import K3P, random
+import K3P, random, atexit
 from unittest import TestCase
 from ConfigParser import *
 
@@ -10,7 +10,7 @@ class KMODTestCase(TestCase):
             TestCase.fail(self, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failIf(self, expr, msg = None):
@@ -18,7 +18,7 @@ class KMODTestCase(TestCase):
             TestCase.failIf(self, expr, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failUnless(self, expr, msg = None):
@@ -26,7 +26,7 @@ class KMODTestCase(TestCase):
             TestCase.failUnless(self, expr, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failUnlessRaises(self, excClass, callableObj, *args, **kwargs):
@@ -34,7 +34,7 @@ class KMODTestCase(TestCase):
             TestCase.failUnlessRaises(self, excClass, callableObj, *args, **kwargs)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failUnlessEqual(self, first, second, msg = None):
@@ -42,7 +42,7 @@ class KMODTestCase(TestCase):
             TestCase.failUnlessEqual(self, first, second, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failIfEqual(self, first, second, msg = None):
@@ -50,7 +50,7 @@ class KMODTestCase(TestCase):
             TestCase.failIfEqual(self, first, second, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failUnlessAlmostEqual(self, first, second, places = 7, msg = None):
@@ -58,7 +58,7 @@ class KMODTestCase(TestCase):
             TestCase.failUnlessAlmostEqual(self, first, second, places, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     def failIfAlmostEqual(self, first, second, places = 7, msg = None):
@@ -66,7 +66,7 @@ class KMODTestCase(TestCase):
             TestCase.failIfAlmostEqual(self, first, second, places, msg)
         except:
             self.kmod.stop()
-            self.kmod.save_logs(self.destdir)
+            self.kmod.save_logs(self.destdir, self.id())
             raise
 
     assertEqual = assertEquals = failUnlessEqual
@@ -82,23 +82,71 @@ class KMODTestCase(TestCase):
         self.kmod = kmod
         self.destdir = destdir
 
-def kmod_from_cfg(cfg_parser, cfg_section):
-    kmod = K3P.Plugin(cfg_parser.get("kmod", "kmod"), kmod_timeout = cfg_parser.getint("kmod", "timeout"))
+def plugin_from_cfg(cfg_parser):
+    """
+    Create a K3P.Plugin from the [kmod] section.
+    """
+    unix = cfg_parser.has_option("kmod", "unix") and cfg_parser.getboolean("kmod", "unix")
+    template = None
+    if cfg_parser.has_option("kmod", "template") and cfg_parser.get("kmod", "template"):
+        template = cfg_parser.get("kmod", "template")
+    return K3P.Plugin(cfg_parser.get("kmod", "kmod"),
+                      kmod_timeout = cfg_parser.getint("kmod", "timeout"),
+                      kmod_unix = unix,
+                      kmod_template = template)
 
-    kmod.full_name = cfg_parser.get("member", "full_name")
-    kmod.pod_addr = cfg_parser.get("member", "pod_addr")
-    kmod.username = cfg_parser.get("member", "username")
-    kmod.password = cfg_parser.get("member", "password")
-    kmod.kps_host = cfg_parser.get("member", "host")
-    kmod.kps_port = int(cfg_parser.get("member", "port"))
+def kmod_from_cfg(cfg_parser, cfg_section):
+    """
+    Create a K3P.Plugin from the [kmod] section, logging in with the
+    KPS account of section cfg_section.
+    """
+    kmod = plugin_from_cfg(cfg_parser)
+
+    kmod.full_name = cfg_parser.get(cfg_section, "full_name")
+    kmod.pod_addr = cfg_parser.get(cfg_section, "pod_addr")
+    kmod.username = cfg_parser.get(cfg_section, "username")
+    kmod.password = cfg_parser.get(cfg_section, "password")
+    kmod.kps_host = cfg_parser.get(cfg_section, "host")
+    kmod.kps_port = int(cfg_parser.get(cfg_section, "port"))
 
     return kmod
 
+# Path -> K3P.IndexedPasswordQuery, so that messages share the cache.
+password_dbs = {}
+
+def password_db(path):
+    """
+    Return the password provider for the sqlite database at path.
+    """
+    if not path in password_dbs:
+        password_dbs[path] = K3P.IndexedPasswordQuery(path)
+    return password_dbs[path]
+
+# The MailWaitListener of the process, see mail_listener().
+_mail_listener = None
+
+def mail_listener(group = None):
+    """
+    Return the MailWaitListener of the process, started on first use
+    and stopped at exit.  Mail delivered by postfix then goes to its
+    wait() method instead of mailwait_dir.  This is meant for test
+    scripts waiting for mail, which must call it before the mail is
+    sent.  See MailWaitListener for group.
+    """
+    global _mail_listener
+    if not _mail_listener:
+        # pyinotify is only needed by the tests waiting for mail.
+        import mailwait
+        _mail_listener = mailwait.MailWaitListener(group = group)
+        _mail_listener.start()
+        atexit.register(_mail_listener.stop)
+    return _mail_listener
+
 def msg_from_cfg(cfg_parser, cfg_section):
     msg = K3P.Message()
 
     # Check we have all the elements we need in the ini section.
-    for k in ["from_name", "from_addr", "to", "cc", "subject", "nonmember-passwords"]:
+    for k in ["from_name", "from_addr", "to", "cc", "subject"]:
         if not cfg_parser.has_option(cfg_section, k):
             raise Exception("Missing element %s in section %s" % (k, cfg_section))
 
@@ -117,9 +165,15 @@ def msg_from_cfg(cfg_parser, cfg_section):
         if len(addr) > 0:
             msg.cc.append(addr)
 
-    pwds_text = cfg_parser.get(cfg_section, "nonmember-passwords")
+    if not cfg_parser.has_option(cfg_section, "nonmember-passwords-db") and \
+       not cfg_parser.has_option(cfg_section, "nonmember-passwords"):
+        raise Exception("Missing element nonmember-passwords in section %s" % cfg_section)
+
+    pwd_hash = {}
+    pwds_text = ""
+    if cfg_parser.has_option(cfg_section, "nonmember-passwords"):
+        pwds_text = cfg_parser.get(cfg_section, "nonmember-passwords")
     if len(pwds_text) > 0:
-        pwd_hash = {}
         pwds = pwds_text.split(";")
         for p in pwds:
             try:
@@ -127,8 +181,15 @@ def msg_from_cfg(cfg_parser, cfg_section):
                 pwd_hash[pwd_email] = (pwd, bool(int(pwd_otut)))
             except:
                 raise Exception("Incorrect format for non-member encryption password")
+
+    # The passwords given in the file are loaded in the database, if
+    # there is one.
+    if cfg_parser.has_option(cfg_section, "nonmember-passwords-db"):
+        msg.passwords = password_db(cfg_parser.get(cfg_section, "nonmember-passwords-db"))
+        if pwd_hash: msg.passwords.update(pwd_hash)
+    elif pwd_hash:
         msg.passwords = K3P.EncryptionPasswordQuery(pwd_hash)
-        
+
     msg.subject = cfg_parser.get(cfg_section, "subject")
 
     # Add weird data as bodies.
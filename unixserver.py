@@ -0,0 +1,104 @@
+# UNIX socket servers of the test tools.
+#
+# The mailwait listener and kprobed serve local clients on a UNIX
+# socket.  An existing socket is only replaced if nothing answers on
+# it anymore, so starting a second instance fails instead of taking
+# the socket of the one running.  Likewise, stop() only removes the
+# socket if it is still the one that was bound.
+
+import os, stat, socket, select, threading
+
+__all__ = ['UnixServer', 'unix_socket_alive']
+
+def unix_socket_alive(path):
+    """
+    Return True if something accepts connections on the UNIX socket
+    at path.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+class UnixServer:
+    """
+    Serve the UNIX socket at 'path' from a background thread between
+    start() and stop().  Each connection is passed to handler in a
+    thread of its own, then closed.  Socket errors of a connection
+    are ignored.
+
+    'mode' is the permission of the socket, and 'group', if given,
+    the ID of the group it is given to.
+    """
+
+    def __init__(self, path, handler, mode = stat.S_IRWXU, group = None):
+        self.path = path
+        self.handler = handler
+        self.mode = mode
+        self.group = group
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.inode = None
+
+    def start(self):
+        """
+        Bind the socket and start serving it.
+        """
+        if os.path.exists(self.path):
+            if unix_socket_alive(self.path):
+                raise Exception("%s is already in use." % self.path)
+            os.unlink(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+        self.inode = os.stat(self.path).st_ino
+
+        if self.group != None:
+            os.chown(self.path, -1, self.group)
+        os.chmod(self.path, self.mode)
+
+        self.running = True
+        self.thread = threading.Thread(target = self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop serving and remove the socket.
+        """
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError: pass
+
+    def _serve(self):
+        while self.running:
+            (rd, _, _) = select.select([self.sock], [], [], 0.5)
+            if not rd: continue
+
+            (conn, _) = self.sock.accept()
+            t = threading.Thread(target = self._serve_client, args = (conn,))
+            t.setDaemon(True)
+            t.start()
+
+    def _serve_client(self, conn):
+        try:
+            self.handler(conn)
+        except socket.error:
+            pass
+        finally:
+            conn.close()